@@ -29,7 +29,7 @@ __version__ = '2.5.0'
 #   1. Insert text for the equation number in each equation.
 #      For LaTeX, change to a numbered equation and use \label{...}
 #      instead.  The equation labels and associated equation numbers
-#      are stored in the global targets tracker.
+#      are stored in the filter's targets tracker.
 #
 #   2. Replace each reference with an equation number.  For LaTeX,
 #      replace with \ref{...} instead.
@@ -39,202 +39,591 @@ __version__ = '2.5.0'
 
 # pylint: disable=invalid-name
 
+import io
+import os
 import re
-import functools
-import argparse
-import json
-import copy
-import textwrap
-import uuid
-
-from pandocfilters import walk
-from pandocfilters import Math, RawInline, Str, Span
-
-import pandocxnos
-from pandocxnos import PandocAttributes
-from pandocxnos import STRTYPES, STDIN, STDOUT, STDERR
-from pandocxnos import elt, check_bool, get_meta
-from pandocxnos import repair_refs, process_refs_factory, replace_refs_factory
-from pandocxnos import attach_attrs_factory, detach_attrs_factory
-from pandocxnos import insert_secnos_factory, delete_secnos_factory
-from pandocxnos import version
+import sys
+from array import array
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # Python 2
+    from collections import MutableMapping  # pylint: disable=W4904
 
 # Patterns for matching labels and references
 LABEL_PATTERN = re.compile(r'(eq:[\w/-]*)')
 
-# Meta variables; may be reset elsewhere
-cleveref = False    # Flags that clever references should be used
-capitalise = False  # Flags that plusname should be capitalised
-plusname = ['eq.', 'eqs.']            # Sets names for mid-sentence references
-starname = ['Equation', 'Equations']  # Sets names for refs at sentence start
-numbersections = False  # Flags that equations should be numbered by section
-secoffset = 0           # Section number offset
-eqref = False           # Flags that \eqref should be used
-warninglevel = 2        # 0 - no warnings; 1 - some warnings; 2 - all warnings
-default_env = 'equation'
+# Pattern for matching json strings that could open an attributes list
+ATTRS_PATTERN = re.compile(br'"c"\s*:\s*"\{')
+
+# Standard streams; STDERR is shared with pandocxnos once it is imported
+if sys.version_info > (3,):
+    STDIN = io.TextIOWrapper(sys.stdin.buffer, 'utf-8', 'strict')
+    STDOUT = io.TextIOWrapper(sys.stdout.buffer, 'utf-8', 'strict')
+    STDERR = io.TextIOWrapper(sys.stderr.buffer, 'utf-8', 'strict')
+else:
+    STDIN = sys.stdin
+    STDOUT = sys.stdout
+    STDERR = sys.stderr
+
+
+# Dependencies ---------------------------------------------------------------
+
+# The filter's dependencies (pandocxnos in particular, which pulls in psutil,
+# inspect, subprocess and more) take much longer to import than the rest of
+# this module.  They aren't needed for --version, by the server client, or for
+# documents that are passed straight through.  _import_deps() imports them
+# and binds their names in this module when they are first needed.
+
+# pylint: disable=global-statement, global-variable-undefined, unused-import
+# pylint: disable=import-outside-toplevel, redefined-outer-name
+def _import_deps():
+    """Imports the filter's dependencies."""
+
+    global textwrap
+    global Math, RawInline, Str, Span
+    global pandocxnos, PandocAttributes, STRTYPES
+    global elt, check_bool, get_meta
+    global repair_refs, process_refs_factory, replace_refs_factory
+    global attach_attrs_factory, detach_attrs_factory
+    global insert_secnos_factory, delete_secnos_factory
+    global version
+    global AttrMath
 
-# Processing state variables
-cursec = None    # Current section
-Ntargets = 0  # Number of targets in current section (or document)
-targets = {}  # Global targets tracker
+    if 'AttrMath' in globals():
+        return
 
-# Processing flags
-plusname_changed = False          # Flags that the plus name changed
-starname_changed = False          # Flags that the star name changed
-has_unnumbered_equations = False  # Flags unnumbered equations were found
+    import textwrap
 
-PANDOCVERSION = None
-AttrMath = None
+    from pandocfilters import Math, RawInline, Str, Span
 
+    import pandocxnos
+    from pandocxnos import PandocAttributes, STRTYPES
+    from pandocxnos import elt, check_bool, get_meta
+    from pandocxnos import repair_refs, process_refs_factory
+    from pandocxnos import replace_refs_factory
+    from pandocxnos import attach_attrs_factory, detach_attrs_factory
+    from pandocxnos import insert_secnos_factory, delete_secnos_factory
+    from pandocxnos import version
 
-# Actions --------------------------------------------------------------------
+    # Share stderr
+    pandocxnos.core.STDERR = STDERR
 
-# pylint: disable=too-many-branches
-def _process_equation(value, fmt):
-    """Processes the equation.  Returns a dict containing eq properties."""
+    # Versions are compared for every reference; parse each only once
+    version = pandocxnos.core.version = _memoize(version)
 
-    # pylint: disable=global-statement
-    global Ntargets                  # Global targets counter
-    global cursec                    # Current section
-    global has_unnumbered_equations  # Flags that unnumbered eqs were found
+    # Element primitives
+    AttrMath = elt('Math', 3)
 
-    # Initialize the return value
-    eq = {'is_unnumbered': False,
-          'is_unreferenceable': False,
-          'is_tagged': False}
 
-    # Parse the equation
-    attrs = eq['attrs'] = PandocAttributes(value[0], 'pandoc')
+def _memoize(func):
+    """Returns `func`, remembering its result for each argument."""
+    results = {}
+    def memoized(arg):
+        """Returns the remembered result for `arg`."""
+        if arg not in results:
+            results[arg] = func(arg)
+        return results[arg]
+    return memoized
+
+
+# Pandoc version -------------------------------------------------------------
+
+# Some of the AST's layout depends on the pandoc version.  Pandoc gives it to
+# filters in the PANDOC_VERSION environment variable, but it may be missing
+# (e.g., for json written by pandoc and filtered later).  pandocxnos would
+# then take any document with a `pandoc-api-version` to be from pandoc 1.18,
+# and run `pandoc -v` for older documents.  Instead, the version is taken from
+# the api version where possible, and otherwise the output of `pandoc -v` is
+# cached in PANDOC_VERSION_CACHE, keyed by the path of the pandoc executable
+# and checked against its modification time and size.  pandocxnos is then
+# initialized directly, as pandocxnos.init() also inspects the call stack
+# (reading the source of every frame) to find the filter's name.
+
+# The first api version used by each release of pandoc that changed the
+# layouts that pandocxnos distinguishes, latest first.  Later api versions are
+# taken to be from the latest of these releases.
+PANDOC_API_VERSIONS = [((1, 22), '2.11'),
+                       ((1, 21), '2.10'),
+                       ((1, 20), '2.8'),
+                       ((1, 17, 1), '2.0'),
+                       ((1, 17), '1.18')]
+
+PANDOC_VERSION_CACHE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'pandoc-eqnos', 'pandoc-versions.json')
+
+
+def api_pandoc_version(api):
+    """Returns the pandoc version for the api version `api` (a list of
+    ints), or None if it is unknown."""
+    for first, pandocversion in PANDOC_API_VERSIONS:
+        if tuple(api) >= first:
+            return pandocversion
+    return None
 
-    # Bail out if the label does not conform to expectations
-    if not LABEL_PATTERN.match(attrs.id):
-        eq.update({'is_unnumbered':True, 'is_unreferenceable':True})
-        return eq
 
-    # Identify unreferenceable equations
-    if attrs.id == 'eq:': # Make up a unique description
-        attrs.id += str(uuid.uuid4())
-        eq['is_unreferenceable'] = True
-
-    # Update the current section number
-    if attrs['secno'] != cursec:  # The section number changed
-        cursec = attrs['secno']   # Update the global section tracker
-        if numbersections:
-            Ntargets = 0          # Resets the global targets counter
-
-    # Increment the targets counter
-    if 'tag' not in attrs:
-        Ntargets += 1
-
-    # Pandoc's --number-sections supports section numbering latex/pdf, html,
-    # epub, and docx
-    if numbersections:
-        # Latex/pdf supports equation numbers by section natively.  For the
-        # other formats we must hard-code in equation numbers by section as
-        # tags.
-        if fmt in ['html', 'html4', 'html5', 'epub', 'epub2', 'epub3', 'docx'] and \
-          'tag' not in attrs:
-            attrs['tag'] = str(cursec+secoffset) + '.' + str(Ntargets)
-
-    # Save reference information
-    eq['is_tagged'] = 'tag' in attrs
-    if eq['is_tagged']:   # ... then save the tag
-        # Remove any surrounding quotes
-        if attrs['tag'][0] == '"' and attrs['tag'][-1] == '"':
-            attrs['tag'] = attrs['tag'].strip('"')
-        elif attrs['tag'][0] == "'" and attrs['tag'][-1] == "'":
-            attrs['tag'] = attrs['tag'].strip("'")
-        targets[attrs.id] = pandocxnos.Target(attrs['tag'], cursec,
-                                              attrs.id in targets)
-    else:
-        targets[attrs.id] = pandocxnos.Target(Ntargets, cursec,
-                                              attrs.id in targets)
+def _pandoc_command():
+    """Returns the path to the pandoc executable that is running this filter,
+    or to the one on the path."""
+    import shutil  # pylint: disable=import-outside-toplevel
+    try:  # As pandocxnos does
+        import psutil  # pylint: disable=import-outside-toplevel
+        parent = psutil.Process(os.getpid()).parent()
+        if os.name == 'nt':
+            parent = parent.parent()
+        command = parent.exe()
+        if os.path.basename(command).startswith('pandoc'):
+            return command
+    except Exception:  # pylint: disable=broad-except
+        pass
+    return getattr(shutil, 'which', lambda name: None)('pandoc') or 'pandoc'
+
+
+def _pandoc_version(output):
+    """Returns the pandoc version given in the `pandoc --version` output
+    (bytes)."""
+    return output.decode('utf-8', 'replace').split('\n')[0].split(' ')[-1]\
+      .strip()
+
+
+def cached_pandoc_version(command, cachepath=None):
+    """Returns the version of the pandoc executable `command`, running it
+    only if its version isn't in the cache at `cachepath` (default
+    PANDOC_VERSION_CACHE).  Returns None if the version can't be found."""
+    import json  # pylint: disable=import-outside-toplevel
+    import subprocess  # pylint: disable=import-outside-toplevel
+    cachepath = cachepath or PANDOC_VERSION_CACHE
+    try:
+        stat = os.stat(command)
+        path, signature = os.path.realpath(command), \
+          [stat.st_mtime, stat.st_size]
+    except (IOError, OSError):  # E.g., a command found on the path
+        path = None
+    try:
+        with open(cachepath) as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        cache = {}
+    if not isinstance(cache, dict):
+        cache = {}
+    if path and path in cache and cache[path][:2] == signature:
+        return cache[path][2]
+
+    try:
+        output = subprocess.check_output([command, '-v'])
+    except (IOError, OSError, subprocess.CalledProcessError):
+        return None
+    pandocversion = _pandoc_version(output)
+
+    if path:
+        cache[path] = signature + [pandocversion]
+        tmppath = '%s.%d.tmp' % (cachepath, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(cachepath)):
+                os.makedirs(os.path.dirname(cachepath))
+            with open(tmppath, 'w') as f:
+                json.dump(cache, f)
+            os.rename(tmppath, cachepath)
+        except (IOError, OSError):  # The cache is only an optimization
+            pass
+    return pandocversion
+
+
+def resolve_pandoc_version(pandocversion, doc):
+    """Returns the pandoc version for `doc`, avoiding running pandoc where
+    possible.  A given `pandocversion` is returned as is.  Returns None if
+    the version can't be found."""
+    if pandocversion:
+        return pandocversion
+    if os.environ.get('PANDOC_VERSION'):
+        return str(os.environ['PANDOC_VERSION'])
+    if isinstance(doc, dict) and 'pandoc-api-version' in doc:
+        pandocversion = api_pandoc_version(doc['pandoc-api-version'])
+        if pandocversion:
+            return pandocversion
+    return cached_pandoc_version(_pandoc_command())
+
+
+def init_pandocxnos(pandocversion, doc):
+    """Initializes pandocxnos for the document `doc` as pandocxnos.init()
+    does, resolving the pandoc version using resolve_pandoc_version().
+    Returns the pandoc version."""
+    pandocversion = resolve_pandoc_version(pandocversion, doc)
+    core = pandocxnos.core
+    if pandocversion is None or \
+      not hasattr(core, '_get_pandoc_version'):  # Leave it to pandocxnos
+        return pandocxnos.init(pandocversion, doc)
+    # pylint: disable=protected-access
+    core._PANDOCVERSION = core._get_pandoc_version(pandocversion, doc)
+    core._FILTERNAME = __name__.replace('_', '-')
+    core._cleveref_flag = None
+    core._sec = 0
+    return core._PANDOCVERSION
+
+
+# Traversal ------------------------------------------------------------------
+
+# Each pass applies a chain of actions to the document.  Rather than walking
+# the tree once per action (as repeated calls to pandocfilters.walk() would),
+# the chain is applied to each element in a single visit.  Replacements
+# returned by one action are handed to the next action in the chain, which
+# mimics the successive walks.  The elements' children are visited after the
+# chain is done with their parent.
+#
+# Some actions (e.g., attach_attrs_span) must see an element only after its
+# children have been processed by all of the other actions.  These are given
+# as `post_actions`, which are applied on the way back up the tree.
+#
+# The tree is modified in place rather than copied, and it is walked using an
+# explicit stack so that deeply nested documents cannot exhaust python's
+# recursion limit.
+
+def _apply_chain(item, actions, fmt, meta):
+    """Applies the chain of `actions` to the element `item`.  Returns the list
+    of elements that result."""
+    els = [item]
+    for action in actions:
+        tmp = []
+        for el in els:
+            if not (isinstance(el, dict) and 't' in el):
+                tmp.append(el)
+                continue
+            res = action(el['t'], el['c'] if 'c' in el else None, fmt, meta)
+            if res is None:
+                tmp.append(el)
+            elif isinstance(res, list):
+                tmp.extend(res)
+            else:
+                tmp.append(res)
+        els = tmp
+    return els
 
-    return eq
 
+# Marks a frame that has no element whose children are being walked
+_IDLE = object()
 
-def _adjust_equation(fmt, eq, value):
-    """Adjusts the equation depending on the output format."""
-    attrs = eq['attrs']
-    num = targets[attrs.id].num
+def _frame(x):
+    """Returns a stack frame for walking the list or dict `x`.  A frame is
+    the list [items, x, out, pending, current]: an iterator over the items
+    of `x` (the values for a dict), the list `x` itself (None for a dict),
+    the items for the list's new contents, the elements still to be walked
+    for the current item (in reverse order), and the element whose children
+    are being walked (or _IDLE)."""
+    if isinstance(x, list):
+        return [iter(x), x, [], [], _IDLE]
+    return [iter(x.values()), None, None, None, _IDLE]
 
-    if fmt in ['latex', 'beamer']:
-        if not eq['is_unreferenceable']:  # Code in the tags
-            if eq['is_tagged']:
-                value[-1] += r'\tag{%s}\label{%s}' % \
-                  (num.replace(' ', r'\ '), attrs.id)
+
+# pylint: disable=too-many-branches
+def fused_walk(x, actions, fmt, meta, post_actions=(), flags=None, mask=0):
+    """Walks the tree `x`, applying the chain of `actions` to every element
+    in a single traversal.  `post_actions` are applied to an element after
+    its children have been walked.  The action contract is the same as for
+    pandocfilters.walk().
+
+    If `flags` (from scan()) is given, then elements whose flags do not
+    intersect `mask` are passed over.
+
+    The lists and dicts in `x` are modified in place.  Returns `x`."""
+
+    if not isinstance(x, (list, dict)):
+        return x
+
+    stack = [_frame(x)]
+    while stack:
+        frame = stack[-1]
+
+        # Walk the values of a dict
+        if frame[1] is None:
+            for value in frame[0]:
+                if isinstance(value, (list, dict)):
+                    stack.append(_frame(value))
+                    break
             else:
-                value[-1] += r'\label{%s}'%attrs.id
-    elif fmt in ('html', 'html4', 'html5', 'epub', 'epub2', 'epub3'):
-        pass  # Insert html in _add_markup() instead
-    else:  # Hard-code in the number/tag
-        if isinstance(num, int):  # Numbered reference
-            value[-1] += r'\qquad (%d)' % num
-        else:  # Tagged reference
-            assert isinstance(num, STRTYPES)
-            num = num.replace(' ', r'\ ')
-            value[-1] += r'\qquad (%s)' % \
-              (num[1:-1] if num.startswith('$') and num.endswith('$') else
-               r'\text{%s}' % num)
+                stack.pop()
+            continue
 
+        items, lst, out, pending, el = frame
 
-def _add_markup(fmt, eq, value):
-    """Adds markup to the output."""
+        # Finish the element whose children were walked
+        if el is not _IDLE:
+            frame[4] = _IDLE
+            if post_actions and isinstance(el, dict) and 't' in el:
+                out.extend(_apply_chain(el, post_actions, fmt, meta))
+            else:
+                out.append(el)
 
-    attrs = eq['attrs']
+        while True:
 
-    # Context-dependent output
-    if eq['is_unnumbered']:  # Unnumbered is also unreferenceable
-        ret = None
-    elif fmt in ['latex', 'beamer']:
-        if 'env' in attrs:
-            env = attrs['env']
+            # Get the next element produced by the chain, or else apply the
+            # chain to the next item in the list
+            if pending:
+                el = pending.pop()
+            else:
+                for el in items:
+                    if isinstance(el, dict) and 't' in el:
+                        if flags is not None and \
+                          not flags.get(id(el), 0) & mask:
+                            out.append(el)
+                            continue
+                        pending.extend(_apply_chain(el, actions, fmt, meta))
+                        pending.reverse()
+                        el = pending.pop()
+                    break
+                else:
+                    lst[:] = out  # Replace the list's contents
+                    stack.pop()
+                    break
+
+            # Walk the element's children (the contents of an element are
+            # walked directly); the element is finished when they are done
+            children = el['c'] if isinstance(el, dict) and 't' in el and \
+              'c' in el else el
+            if isinstance(children, (list, dict)):
+                frame[4] = el
+                stack.append(_frame(children))
+                break
+
+            # Finish a leaf element now
+            if post_actions and isinstance(el, dict) and 't' in el:
+                out.extend(_apply_chain(el, post_actions, fmt, meta))
+            else:
+                out.append(el)
+
+    return x
+
+
+# The second pass has little to do outside of the references.  Rather than
+# walking the tree, it may visit only the reference sites recorded by scan():
+# the inline lists that hold references, paired with their elements, and the
+# paragraphs that the post-actions attend to (those that hold Spans, whose
+# attributes are attached after the references are replaced, and those that
+# hold a lone Image with a reference, Span or Link in it).  References
+# within other references are handled along with them.  Known references
+# are marked by process_refs(), which attaches attributes to their Cite
+# elements; walk_refs() visits just these, and walks into only those that
+# contain other references.
+
+# Flags for scan()
+FIRST_PASS = 1   # Subtree contains Math or Header elements
+SECOND_PASS = 2  # Subtree contains references, Spans or Links
+NESTED_REFS = 4  # Reference contains other references
+
+# Flags for elements by type; Cite elements are flagged separately
+_ELEMENT_FLAGS = {'Math': FIRST_PASS, 'Header': FIRST_PASS,
+                  'Span': SECOND_PASS, 'Link': SECOND_PASS}
+
+def _is_paragraph(node):
+    """Returns True if `node` is a Para or Plain element."""
+    return isinstance(node, dict) and node.get('t') in ('Para', 'Plain')
+
+
+def _is_lone(node):
+    """Returns True if `node` is a paragraph holding a single element."""
+    return _is_paragraph(node) and len(node['c']) == 1
+
+
+def _add_site(stack, sites, seen):
+    """Adds the list at the top of the scan() `stack` and its element to the
+    reference `sites`, unless the list is already in the `seen` set of list
+    ids or is inside a reference."""
+    node = stack[-1][0]
+    lst = node['c'] if isinstance(node, dict) else node
+    if id(lst) in seen:
+        return
+    seen.add(id(lst))
+    el = None
+    for entry in reversed(stack):
+        node = entry[0]
+        if isinstance(node, dict) and 't' in node:
+            if node['t'] == 'Cite' and \
+              any(LABEL_PATTERN.match(citation['citationId'])
+                  for citation in node['c'][-2]):
+                entry[2] |= NESTED_REFS  # Walked with the enclosing reference
+                return
+            if el is None:
+                el = node
+    sites.append((el, lst))
+
+
+def scan(x, sites=None):
+    """Scans the tree `x` for subtrees that need processing by the first
+    and/or second passes.  Returns a dict that maps element ids to flags.
+    If a `sites` list is given, then the reference sites are appended to it
+    in document order.
+
+    Elements are modified in place by fused_walk(), so the flags remain
+    valid for the second pass.  Any new elements created by the first pass
+    are not flagged, which is fine because they never contain references.
+    The id of a discarded element may be reused by a new one; at worst this
+    causes an unneeded visit.
+    """
+    flags = {}
+    seen = set()  # Ids of the lists added to the sites
+
+    # Each stack entry is the list [node, children, flags].  A node's flags
+    # are combined with those of its children once they are all scanned.
+    # Only the flags for elements are kept.  The contents of an element are
+    # taken as its children directly.
+    stack = [[x, iter(x if isinstance(x, list) else x.values()), 0]]
+    while stack:
+        entry = stack[-1]
+        for child in entry[1]:
+            if isinstance(child, list):
+                stack.append([child, iter(child), 0])
+                break
+            if isinstance(child, dict):
+                if 't' not in child:
+                    stack.append([child, iter(child.values()), 0])
+                    break
+                key = child['t']
+                ret = _ELEMENT_FLAGS.get(key, 0)
+                if key == 'Cite':
+                    for citation in child['c'][-2]:
+                        if LABEL_PATTERN.match(citation['citationId']):
+                            ret = SECOND_PASS
+                    if ret and sites is not None:
+                        _add_site(stack, sites, seen)
+                elif key == 'Span' and sites is not None and \
+                  _is_paragraph(entry[0]):
+                    _add_site(stack, sites, seen)
+                value = child['c'] if 'c' in child else None
+                if isinstance(value, list):
+                    stack.append([child, iter(value), ret])
+                    break
+                if isinstance(value, dict):
+                    stack.append([child, iter((value,)), ret])
+                    break
+                if ret:  # A leaf element
+                    flags[id(child)] = ret
+                    entry[2] |= ret
         else:
-            env = default_env
-        env, _, arg = env.partition('.')
-        ret = RawInline('tex',
-                        r'\begin{%s}%s%s\end{%s}'% \
-                        (env, '{%s}'%arg if arg else '', value[-1], env))
-    elif fmt in ('html', 'html4', 'html5', 'epub', 'epub2', 'epub3') and \
-      LABEL_PATTERN.match(attrs.id):
-        # Present equation and its number in a span
-        num = str(targets[attrs.id].num)
-        outer = RawInline('html',
-                          '<span%sclass="eqnos">' % \
-                            (' ' if eq['is_unreferenceable'] else
-                             ' id="%s" '%attrs.id))
-        inner = RawInline('html', '<span class="eqnos-number">')
-        eqno = Math({"t":"InlineMath"}, '(%s)' % num[1:-1]) \
-          if num.startswith('$') and num.endswith('$') \
-          else Str('(%s)' % num)
-        endtags = RawInline('html', '</span></span>')
-        ret = [outer, AttrMath(*value), inner, eqno, endtags]
-    elif fmt == 'docx':
-        # As per http://officeopenxml.com/WPhyperlink.php
-        bookmarkstart = \
-          RawInline('openxml',
-                    '<w:bookmarkStart w:id="0" w:name="%s"/><w:r><w:t>'
-                    %attrs.id)
-        bookmarkend = \
-          RawInline('openxml',
-                    '</w:t></w:r><w:bookmarkEnd w:id="0"/>')
-        ret = [bookmarkstart, AttrMath(*value), bookmarkend]
-    else:
-        ret = None
-    return ret
-
-
-def process_equations(key, value, fmt, meta):  # pylint: disable=unused-argument
-    """Processes the attributed equations."""
-
-    # Process attributed equations and add markup
-    if key == 'Math' and len(value) == 3:
-        eq = _process_equation(value, fmt)
-        if eq['attrs'].id:
-            _adjust_equation(fmt, eq, value)
-        return _add_markup(fmt, eq, value)
-
-    return None
+            stack.pop()
+            node, _, ret = entry
+            if ret:
+                if isinstance(node, dict) and 't' in node:
+                    flags[id(node)] = ret
+                    if sites is not None and ret & SECOND_PASS and \
+                      node['t'] == 'Image' and _is_lone(stack[-1][0]):
+                        _add_site(stack, sites, seen)
+                if stack:
+                    stack[-1][2] |= ret
+    return flags
+
+
+# pylint: disable=too-many-arguments
+def walk_refs(sites, actions, fmt, meta, post_actions=(), flags=None):
+    """Applies the chain of `actions` at the reference `sites` from scan().
+    For each site, the chain is applied to the element, the Cite elements in
+    the list that were given attributes by the chain are walked as by
+    fused_walk(), and then the `post_actions` are applied to the element.
+    The chain must not replace the sites' elements.
+
+    If `flags` (from scan()) is given, then the chain's replacements for
+    references that don't contain other references are not walked into.
+    Returns `sites`."""
+    for el, lst in sites:
+        _apply_chain(el, actions, fmt, meta)
+        out = []
+        for item in lst:
+            if not (isinstance(item, dict) and item.get('t') == 'Cite' and
+                    len(item['c']) == 3):
+                out.append(item)
+            elif flags is None or flags.get(id(item), 0) & NESTED_REFS:
+                out.extend(fused_walk([item], actions, fmt, meta,
+                                      post_actions))
+            else:
+                for res in _apply_chain(item, actions, fmt, meta):
+                    out.extend(_apply_chain(res, post_actions, fmt, meta))
+        lst[:] = out
+        _apply_chain(el, post_actions, fmt, meta)
+    return sites
+
+
+# Profiling ------------------------------------------------------------------
+
+# When the PANDOC_EQNOS_PROFILE environment variable is set (or the --profile
+# option is given), main() collects timings and counts in a Profile and
+# reports them to stderr as a line of json when it is done.  The report
+# gives the times taken to read, parse, filter, serialize and write the
+# document; for each pass, the time taken, the number of elements visited,
+# and the time, calls and replacements for each action; and the numbers of
+# equations processed and references replaced.  Action times include the
+# profiling overhead.
+
+class Profile(object):
+    """Collects timings and counts for a filter run."""
+
+    def __init__(self):
+        import time  # pylint: disable=import-outside-toplevel
+        self.timer = getattr(time, 'perf_counter', time.time)
+        self.start = self.timer()
+        self.times = {}   # Stage names to times
+        self.passes = {}  # Pass names to pass statistics
+        self.counts = {}  # Names to counts
+
+    def timed(self, name, func, *args):
+        """Calls `func(*args)`, adding the time taken to the stage `name`.
+        Returns the result."""
+        start = self.timer()
+        try:
+            return func(*args)
+        finally:
+            self.times[name] = self.times.get(name, 0) + self.timer() - start
+
+    def _wrap(self, stats, action):
+        """Returns `action` wrapped to record its time, calls and
+        replacements in the `stats` dict."""
+        timer = self.timer
+        def wrapped(key, value, fmt, meta):
+            """Calls the action."""
+            start = timer()
+            ret = action(key, value, fmt, meta)
+            stats['time'] += timer() - start
+            stats['calls'] += 1
+            if ret is not None:
+                stats['replacements'] += 1
+            return ret
+        return wrapped
+
+    # pylint: disable=too-many-arguments
+    def walk(self, name, walker, x, actions, fmt, meta, post_actions=(),
+             *args):
+        """Walks `x` using `walker` (fused_walk() or walk_refs()) and records
+        statistics for the pass `name`, adding to those from any earlier
+        walks for it.  Any further `args` are passed to the walker.  Returns
+        the walker's result."""
+        stats = self.passes.setdefault(name, {'actions': {}, 'time': 0})
+        wrapped = []
+        for action in list(actions) + list(post_actions):
+            wrapped.append(self._wrap(stats['actions'].setdefault(
+                action.__name__, {'time': 0, 'calls': 0, 'replacements': 0}),
+                                      action))
+        start = self.timer()
+        x = walker(x, wrapped[:len(actions)], fmt, meta,
+                   wrapped[len(actions):], *args)
+        stats['time'] += self.timer() - start
+        # Every element visited is handed to the first action in the chain
+        stats['nodes'] = stats['actions'][actions[0].__name__]['calls']
+        return x
+
+    def count(self, name, n):
+        """Adds `n` to the count `name`."""
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def report(self):
+        """Returns the report as a dict."""
+        ret = {'total': self.timer() - self.start, 'passes': self.passes}
+        ret.update(self.times)
+        ret.update(self.counts)
+        return {'pandoc-eqnos-profile': ret}
+
+    def write(self, stream):
+        """Writes the report to `stream` as a line of json."""
+        import json  # pylint: disable=import-outside-toplevel
+        stream.write('\n' + json.dumps(self.report(), sort_keys=True) + '\n')
+        stream.flush()
 
 
 # TeX blocks -----------------------------------------------------------------
@@ -273,277 +662,2773 @@ EQUATION_STYLE_HTML = """
 """
 
 
-# Main program ---------------------------------------------------------------
+# Renderers ------------------------------------------------------------------
 
-# pylint: disable=too-many-statements
-def process(meta):
-    """Saves metadata fields in global variables and returns a few
-    computed fields."""
-
-    # pylint: disable=global-statement
-    global cleveref    # Flags that clever references should be used
-    global capitalise  # Flags that plusname should be capitalised
-    global plusname    # Sets names for mid-sentence references
-    global starname    # Sets names for references at sentence start
-    global numbersections  # Flags that sections should be numbered by section
-    global secoffset       # Section number offset
-    global warninglevel    # 0 - no warnings; 1 - some; 2 - all
-    global plusname_changed  # Flags that the plus name changed
-    global starname_changed  # Flags that the star name changed
-    global eqref             # Flags that \eqref should be used
-    global default_env       # Default equations environment
-
-    # Read in the metadata fields and do some checking
-
-    for name in ['eqnos-warning-level', 'xnos-warning-level']:
-        if name in meta:
-            warninglevel = int(get_meta(meta, name))
-            pandocxnos.set_warning_level(warninglevel)
-            break
+# A renderer produces the format-specific content for equations.  The
+# renderer for the output format is resolved once per document using
+# get_renderer(); formats without a registered renderer use the Renderer
+# base class, which hard-codes the equation numbers into the equations.
+# Further renderers may be added using register_renderer().  References are
+# rendered by pandocxnos and are not affected.
+#
+# Markup that is the same for every equation is made once per document and
+# the same element is inserted for each equation.  These elements are never
+# modified.
 
-    metanames = ['eqnos-warning-level', 'xnos-warning-level',
-                 'eqnos-cleveref', 'xnos-cleveref',
-                 'xnos-capitalise', 'xnos-capitalize',
-                 'xnos-caption-separator', # Used by pandoc-fignos/tablenos
-                 'eqnos-plus-name', 'eqnos-star-name',
-                 'eqnos-number-by-section', 'xnos-number-by-section',
-                 'xnos-number-offset',
-                 'eqnos-eqref',
-                 'eqnos-default-env']
-
-    if warninglevel:
-        for name in meta:
-            if (name.startswith('eqnos') or name.startswith('xnos')) and \
-              name not in metanames:
-                msg = textwrap.dedent("""
-                          pandoc-eqnos: unknown meta variable "%s"\n
-                      """ % name)
-                STDERR.write(msg)
-
-    for name in ['eqnos-cleveref', 'xnos-cleveref']:
-        # 'xnos-cleveref' enables cleveref in all 3 of fignos/eqnos/tablenos
-        if name in meta:
-            cleveref = check_bool(get_meta(meta, name))
-            break
+class Renderer(object):
+    """Renders equations for output formats without special support."""
+
+    # Flags that equation numbers by section must be hard-coded as tags
+    section_tags = False
 
-    for name in ['xnos-capitalise', 'xnos-capitalize']:
-        # 'xnos-capitalise' enables capitalise in all 3 of
-        # fignos/eqnos/tablenos.  Since this uses an option in the caption
-        # package, it is not possible to select between the three (use
-        # 'eqnos-plus-name' instead.  'xnos-capitalize' is an alternative
-        # spelling
-        if name in meta:
-            capitalise = check_bool(get_meta(meta, name))
+    def __init__(self, eqnos):
+        """Parameters:
+
+          eqnos - the EqnosFilter that is using the renderer
+        """
+        self.eqnos = eqnos
+
+    # pylint: disable=no-self-use, unused-argument
+    def adjust(self, eq, value, num):
+        """Adjusts the tex of the equation `value` in place.  `eq` is the
+        Equation and `num` is the equation number or tag.
+        """
+        if isinstance(num, int):  # Numbered reference
+            value[-1] += r'\qquad (%d)' % num
+        else:  # Tagged reference
+            assert isinstance(num, STRTYPES)
+            num = num.replace(' ', r'\ ')
+            value[-1] += r'\qquad (%s)' % \
+              (num[1:-1] if num.startswith('$') and num.endswith('$') else
+               r'\text{%s}' % num)
+
+    def markup(self, eq, value):
+        """Returns the content that replaces the numbered equation `value`, or
+        None to leave it as is."""
+        return None
+
+    def add_headers(self, meta):
+        """Adds any blocks needed by the equations to the header-includes in
+        `meta`."""
+
+
+class LatexRenderer(Renderer):
+    """Renders equations for LaTeX/pdf output."""
+
+    def __init__(self, eqnos):
+        Renderer.__init__(self, eqnos)
+        self.envs = {}  # Environment names to their begin and end tex
+
+    def adjust(self, eq, value, num):
+        if not eq.is_unreferenceable:  # Code in the tags
+            if eq.is_tagged:
+                value[-1] += r'\tag{%s}\label{%s}' % \
+                  (num.replace(' ', r'\ '), eq.attrs.id)
+            else:
+                value[-1] += r'\label{%s}' % eq.attrs.id
+
+    def markup(self, eq, value):
+        attrs = eq.attrs
+        name = attrs['env'] if 'env' in attrs else self.eqnos.default_env
+        if name not in self.envs:
+            env, _, arg = name.partition('.')
+            self.envs[name] = (r'\begin{%s}%s' % \
+                               (env, '{%s}' % arg if arg else ''),
+                               r'\end{%s}' % env)
+        begin, end = self.envs[name]
+        return RawInline('tex', begin + value[-1] + end)
+
+    def add_headers(self, meta):
+        self.eqnos.add_tex(meta)
+
+
+class HtmlRenderer(Renderer):
+    """Renders equations for html and epub output."""
+
+    section_tags = True
+
+    def adjust(self, eq, value, num):
+        pass  # Insert html in markup() instead
+
+    def markup(self, eq, value):
+        # Present equation and its number in a span
+        attrs = eq.attrs
+        if not LABEL_PATTERN.match(attrs.id):
+            return None
+        num = str(self.eqnos.targets[attrs.id].num)
+        outer = RawInline('html', '<span class="eqnos">') \
+          if eq.is_unreferenceable else \
+          RawInline('html', '<span id="' + attrs.id + '" class="eqnos">')
+        eqno = Math({"t":"InlineMath"}, '(' + num[1:-1] + ')') \
+          if num.startswith('$') and num.endswith('$') \
+          else Str('(' + num + ')')
+        # Each equation gets its own elements, so that later filters may
+        # alter them in place
+        return [outer, AttrMath(*value),
+                RawInline('html', '<span class="eqnos-number">'), eqno,
+                RawInline('html', '</span></span>')]
+
+    def add_headers(self, meta):
+        self.eqnos.add_html(meta, self.eqnos.fmt)
+
+
+class DocxRenderer(Renderer):
+    """Renders equations for docx output."""
+
+    section_tags = True
+
+    def markup(self, eq, value):
+        # As per http://officeopenxml.com/WPhyperlink.php
+        bookmarkstart = \
+          RawInline('openxml',
+                    '<w:bookmarkStart w:id="0" w:name="' + eq.attrs.id +
+                    '"/><w:r><w:t>')
+        return [bookmarkstart, AttrMath(*value),
+                RawInline('openxml', '</w:t></w:r><w:bookmarkEnd w:id="0"/>')]
+
+
+RENDERERS = {'latex': LatexRenderer, 'beamer': LatexRenderer,
+             'html': HtmlRenderer, 'html4': HtmlRenderer,
+             'html5': HtmlRenderer, 'epub': HtmlRenderer,
+             'epub2': HtmlRenderer, 'epub3': HtmlRenderer,
+             'docx': DocxRenderer}
+
+def register_renderer(fmt, cls):
+    """Registers the Renderer subclass `cls` for the output format `fmt`."""
+    RENDERERS[fmt] = cls
+
+def get_renderer(fmt):
+    """Returns the Renderer class for the output format `fmt`."""
+    return RENDERERS.get(fmt, Renderer)
+
+
+# Equations and targets -----------------------------------------------------
+
+# A document may have hundreds of thousands of equations, and so the
+# per-equation records are kept small.  An Equation has slots rather than a
+# dict.  A TargetTable keeps the equation numbers and section numbers of the
+# targets in arrays, indexed by each label's position, in place of a dict of
+# Target tuples.  Targets that don't fit (tags, names, or numbers that are
+# not small integers) are kept as Target tuples.  Target tuples are made as
+# the targets are looked up.  The positions of deleted labels are reused.
+
+class Equation(object):
+    """The properties of an equation, for the renderers."""
+
+    __slots__ = ['attrs', 'is_unnumbered', 'is_unreferenceable', 'is_tagged']
+
+    def __init__(self, attrs):
+        self.attrs = attrs                # The PandocAttributes
+        self.is_unnumbered = False        # Flags an unnumbered equation
+        self.is_unreferenceable = False   # Flags a made-up label
+        self.is_tagged = False            # Flags a tagged equation
+
+    def __getitem__(self, name):
+        """Returns the property `name`, as for the dict once used."""
+        return getattr(self, name)
+
+
+class TargetTable(MutableMapping):
+    """Maps equation labels to pandocxnos Target tuples, compactly."""
+
+    def __init__(self, targets=()):
+        self._index = {}            # Labels to positions
+        self._nums = array('i')     # Equation numbers
+        self._secnos = array('i')   # Section numbers
+        self._duplicates = set()    # Positions of duplicated labels
+        self._others = {}           # Positions to Targets that don't fit
+        self._free = []             # Positions freed by deleted labels
+        self.update(targets)
+
+    def __setitem__(self, label, target):
+        num, secno, has_duplicate, name = pandocxnos.Target(*target)
+        pos = self._index.get(label)
+        if pos is None and self._free:  # Reuse a freed position
+            pos = self._index[label] = self._free.pop()
+        elif pos is None:
+            pos = self._index[label] = len(self._nums)
+            self._nums.append(0)
+            self._secnos.append(0)
+        self._others.pop(pos, None)
+        try:
+            if isinstance(num, bool) or name is not None:
+                raise TypeError
+            self._nums[pos] = num
+            self._secnos[pos] = secno
+        except (TypeError, OverflowError):  # A tag, or None, or a big number
+            self._others[pos] = pandocxnos.Target(*target)
+        if has_duplicate:
+            self._duplicates.add(pos)
+        else:
+            self._duplicates.discard(pos)
+
+    def __getitem__(self, label):
+        pos = self._index[label]
+        if pos in self._others:
+            return self._others[pos]
+        return pandocxnos.Target(self._nums[pos], self._secnos[pos],
+                                 pos in self._duplicates)
+
+    def __delitem__(self, label):
+        pos = self._index.pop(label)
+        self._others.pop(pos, None)
+        self._duplicates.discard(pos)
+        if self._index:
+            self._free.append(pos)
+        else:  # Start afresh
+            del self._nums[:], self._secnos[:], self._free[:]
+
+    def __contains__(self, label):
+        return label in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+
+# Filter ---------------------------------------------------------------------
+
+# pylint: disable=too-many-instance-attributes
+class EqnosFilter(object):
+    """Numbers the equations and references in a pandoc document.
+
+    All of the processing state is held by the instance, so that a fresh
+    filter may be used for each document in the same process:
+
+        doc = EqnosFilter(fmt).run(doc)
+
+    The pandocxnos library keeps some module-level state of its own, and so
+    documents must be processed one at a time (i.e., not concurrently in
+    threads).
+    """
+
+    def __init__(self, fmt, pandocversion=None, profile=None):
+        """Parameters:
+
+          fmt - the output format
+          pandocversion - the pandoc version string; if this is None then
+                          it is determined when the document is run
+          profile - a Profile to collect timings and counts in, or None
+        """
+
+        _import_deps()
+
+        self.fmt = fmt
+        self.pandocversion = pandocversion
+        self.profile = profile
+        self.renderer = get_renderer(fmt)(self)
+
+        # Meta variables; may be reset by process()
+        self.cleveref = False    # Flags that clever references should be used
+        self.capitalise = False  # Flags that plusname should be capitalised
+        self.plusname = ['eq.', 'eqs.']  # Names for mid-sentence references
+        self.starname = ['Equation', 'Equations']  # Names for refs at
+                                                   # sentence start
+        self.numbersections = False  # Flags that equations should be
+                                     # numbered by section
+        self.secoffset = 0           # Section number offset
+        self.eqref = False           # Flags that \eqref should be used
+        self.warninglevel = 2        # 0 - no warnings; 1 - some; 2 - all
+        self.default_env = 'equation'
+        self.indexpath = None        # Path to a label index for a book
+        self.chapter = None          # Name of this chapter in the index
+        self.statepath = None        # Path to a state file for incremental
+                                     # filtering
+        self.manifestpath = None     # Path to a label manifest
+        self.depfilepath = None      # Path to a make depfile
+        self.depfiletarget = None    # Target of the depfile's rule
+
+        # Pandoc version flags; set by _start()
+        self.api_doc = True    # Flags a doc with meta and blocks (>= 1.18)
+        self.old_html = False  # Flags html that needs style types (< 2.0)
+
+        # Processing state variables
+        self.cursec = None  # Current section
+        self.Ntargets = 0   # Number of targets in current section (or doc)
+        self.targets = TargetTable()  # Targets tracker
+        self.unreferenceable = []  # Labels made up for unreferenceable eqs
+        self.unreferenceable_offset = 0  # Number made up before this doc
+        self.Nequations = 0        # Number of attributed equations processed
+        self.references = []  # Labels referenced; kept for a manifest only
+        self.indexed = set()  # Labels of the other chapters in the index
+        self.continued = False  # Flags numbering continued from the index
+        self.numbered = []  # Equations and targets from number_equations()
+
+        # Processing flags
+        self.plusname_changed = False  # Flags that the plus name changed
+        self.starname_changed = False  # Flags that the star name changed
+
+
+    # Actions ----------------------------------------------------------------
+
+    # pylint: disable=too-many-branches
+    def _process_equation(self, value, fmt, section_tags=None):
+        """Processes the equation.  Returns its Equation.  Equation numbers
+        by section are hard-coded as tags if `section_tags` is true, or if
+        it is None and the renderer requires it."""
+
+        # Parse the equation
+        attrs = PandocAttributes(value[0], 'pandoc')
+        eq = Equation(attrs)
+
+        # Bail out if the label does not conform to expectations
+        if not LABEL_PATTERN.match(attrs.id):
+            eq.is_unnumbered = eq.is_unreferenceable = True
+            return eq
+
+        # Identify unreferenceable equations
+        if attrs.id == 'eq:': # Make up a unique description
+            # The description is derived from the equation's position and
+            # content so that the same input always gives the same output
+            import uuid  # pylint: disable=import-outside-toplevel
+            attrs.id += str(uuid.uuid5(uuid.NAMESPACE_URL,
+                                       'pandoc-eqnos:%d:%s' % \
+                                       (len(self.unreferenceable) +
+                                        self.unreferenceable_offset + 1,
+                                        value[-1])))
+            self.unreferenceable.append(attrs.id)
+            eq.is_unreferenceable = True
+
+        # Update the current section number
+        if attrs['secno'] != self.cursec:  # The section number changed
+            self.cursec = attrs['secno']   # Update the section tracker
+            if self.numbersections:
+                self.Ntargets = 0          # Resets the targets counter
+
+        # Increment the targets counter
+        if 'tag' not in attrs:
+            self.Ntargets += 1
+
+        # Pandoc's --number-sections supports section numbering latex/pdf,
+        # html, epub, and docx
+        if self.numbersections:
+            # Latex/pdf supports equation numbers by section natively.  For
+            # the other formats we must hard-code in equation numbers by
+            # section as tags.
+            if section_tags is None:
+                section_tags = self.renderer.section_tags
+            if section_tags and 'tag' not in attrs:
+                attrs['tag'] = str(self.cursec+self.secoffset) + '.' + \
+                  str(self.Ntargets)
+
+        # Save reference information
+        eq.is_tagged = 'tag' in attrs
+        if eq.is_tagged:   # ... then save the tag
+            # Remove any surrounding quotes
+            if attrs['tag'][0] == '"' and attrs['tag'][-1] == '"':
+                attrs['tag'] = attrs['tag'].strip('"')
+            elif attrs['tag'][0] == "'" and attrs['tag'][-1] == "'":
+                attrs['tag'] = attrs['tag'].strip("'")
+            self.targets[attrs.id] = \
+              pandocxnos.Target(attrs['tag'], self.cursec,
+                                attrs.id in self.targets)
+        else:
+            self.targets[attrs.id] = \
+              pandocxnos.Target(self.Ntargets, self.cursec,
+                                attrs.id in self.targets)
+
+        return eq
+
+    # pylint: disable=unused-argument
+    def process_equations(self, key, value, fmt, meta):
+        """Processes the attributed equations."""
+
+        # Process attributed equations and add markup
+        if key == 'Math' and len(value) == 3:
+            self.Nequations += 1
+            return self._render_equation(self._process_equation(value, fmt),
+                                         value)
+
+        return None
+
+    def _render_equation(self, eq, value):
+        """Renders the equation `value` using its Equation `eq`.  Returns
+        the content that replaces it, or None."""
+        if eq.attrs.id:
+            self.renderer.adjust(eq, value, self.targets[eq.attrs.id].num)
+        return None if eq.is_unnumbered else self.renderer.markup(eq, value)
+
+
+    # Metadata ---------------------------------------------------------------
+
+    # pylint: disable=too-many-statements
+    def process(self, meta):
+        """Saves metadata fields in the filter's attributes."""
+
+        # Read in the metadata fields and do some checking
+
+        for name in ['eqnos-warning-level', 'xnos-warning-level']:
+            if name in meta:
+                self.warninglevel = int(get_meta(meta, name))
+                break
+        pandocxnos.set_warning_level(self.warninglevel)
+
+        metanames = ['eqnos-warning-level', 'xnos-warning-level',
+                     'eqnos-cleveref', 'xnos-cleveref',
+                     'xnos-capitalise', 'xnos-capitalize',
+                     'xnos-caption-separator', # Used by pandoc-fignos/tablenos
+                     'eqnos-plus-name', 'eqnos-star-name',
+                     'eqnos-number-by-section', 'xnos-number-by-section',
+                     'xnos-number-offset',
+                     'eqnos-eqref',
+                     'eqnos-default-env',
+                     'eqnos-index', 'eqnos-index-chapter',
+                     'eqnos-state', 'eqnos-manifest', 'eqnos-depfile',
+                     'eqnos-depfile-target']
+
+        if self.warninglevel:
+            for name in meta:
+                if (name.startswith('eqnos') or name.startswith('xnos')) and \
+                  name not in metanames:
+                    msg = textwrap.dedent("""
+                              pandoc-eqnos: unknown meta variable "%s"\n
+                          """ % name)
+                    STDERR.write(msg)
+
+        for name in ['eqnos-cleveref', 'xnos-cleveref']:
+            # 'xnos-cleveref' enables cleveref in all 3 of fignos/eqnos/tablenos
+            if name in meta:
+                self.cleveref = check_bool(get_meta(meta, name))
+                break
+
+        for name in ['xnos-capitalise', 'xnos-capitalize']:
+            # 'xnos-capitalise' enables capitalise in all 3 of
+            # fignos/eqnos/tablenos.  Since this uses an option in the caption
+            # package, it is not possible to select between the three (use
+            # 'eqnos-plus-name' instead.  'xnos-capitalize' is an alternative
+            # spelling
+            if name in meta:
+                self.capitalise = check_bool(get_meta(meta, name))
+                break
+
+        if 'eqnos-plus-name' in meta:
+            tmp = get_meta(meta, 'eqnos-plus-name')
+            old_plusname = list(self.plusname)
+            if isinstance(tmp, list):  # The singular and plural forms given
+                self.plusname = tmp
+            else:  # Only the singular form was given
+                self.plusname[0] = tmp
+            self.plusname_changed = self.plusname != old_plusname
+            assert len(self.plusname) == 2
+            for name in self.plusname:
+                assert isinstance(name, STRTYPES)
+            if self.plusname_changed:
+                self.starname = [name.title() for name in self.plusname]
+
+        if 'eqnos-star-name' in meta:
+            tmp = get_meta(meta, 'eqnos-star-name')
+            old_starname = list(self.starname)
+            if isinstance(tmp, list):
+                self.starname = tmp
+            else:
+                self.starname[0] = tmp
+            self.starname_changed = self.starname != old_starname
+            assert len(self.starname) == 2
+            for name in self.starname:
+                assert isinstance(name, STRTYPES)
+
+        for name in ['eqnos-number-by-section', 'xnos-number-by-section']:
+            if name in meta:
+                self.numbersections = check_bool(get_meta(meta, name))
+                break
+
+        if 'xnos-number-offset' in meta:
+            self.secoffset = int(get_meta(meta, 'xnos-number-offset'))
+
+        if 'eqnos-eqref' in meta:
+            self.eqref = check_bool(get_meta(meta, 'eqnos-eqref'))
+            # Note: Eqref and cleveref are mutually exclusive.  If both are
+            # enabled, then cleveref will be used but with bracketed equation
+            # numbers.
+
+        if 'eqnos-default-env' in meta:
+            self.default_env = get_meta(meta, 'eqnos-default-env')
+
+        if 'eqnos-index' in meta:
+            self.indexpath = get_meta(meta, 'eqnos-index')
+
+        if 'eqnos-index-chapter' in meta:
+            self.chapter = str(get_meta(meta, 'eqnos-index-chapter'))
+
+        if 'eqnos-state' in meta:
+            self.statepath = get_meta(meta, 'eqnos-state')
+
+        if 'eqnos-manifest' in meta:
+            self.manifestpath = get_meta(meta, 'eqnos-manifest')
+
+        if 'eqnos-depfile' in meta:
+            self.depfilepath = get_meta(meta, 'eqnos-depfile')
+
+        if 'eqnos-depfile-target' in meta:
+            self.depfiletarget = get_meta(meta, 'eqnos-depfile-target')
+
+
+    # Label index ------------------------------------------------------------
+
+    def continue_from(self, secno, count, targets):
+        """Continues the numbering of a previous document.  `secno` is the
+        current section number, `count` is the number of equations counted so
+        far in that section (or the document), and `targets` maps the labels
+        defined elsewhere to their Target objects.  This must be called after
+        the processing state is initialized and before the first pass."""
+        # pylint: disable=protected-access
+        pandocxnos.core._sec = secno
+        self.cursec = secno
+        self.Ntargets = count
+        self.targets.update(targets)
+
+    def use_index(self, labelindex):
+        """Continues numbering from this chapter's entry in the label index
+        `labelindex`, and resolves references to the other chapters'
+        labels."""
+        chapters = labelindex['chapters']
+        names = [chapter['name'] for chapter in chapters]
+        if self.chapter not in names:
+            if self.warninglevel:
+                STDERR.write(textwrap.dedent("""
+                    pandoc-eqnos: Chapter "%s" is not in the label index %s;
+                    only references to the indexed labels are resolved.
+                """ % (self.chapter, self.indexpath)))
+                STDERR.flush()
+            chapter = None
+        else:
+            chapter = chapters[names.index(self.chapter)]
+
+        # Count the definitions of each label so duplicates can be flagged
+        counts = {}
+        for entry in chapters:
+            for label in entry['labels']:
+                counts[label] = counts.get(label, 0) + 1
+
+        targets = {}
+        for entry in chapters:
+            if entry is chapter:
+                continue
+            for label, (num, secno) in entry['labels'].items():
+                targets[label] = pandocxnos.Target(num, secno,
+                                                   counts[label] > 1)
+
+        self.indexed = set(targets)
+        if chapter:
+            self.continued = bool(chapter['secno'] or chapter['count'])
+            self.continue_from(chapter['secno'], chapter['count'], targets)
+            self.unreferenceable_offset = chapter.get('unreferenceable', 0)
+        else:
+            self.targets.update(targets)
+
+    def index(self, doc, secno=0, count=0):
+        """Numbers the equations in `doc` without filtering it, continuing
+        from the section number `secno` and equation count `count` at the end
+        of the previous chapter.  Returns the tuple (labels, secno, count),
+        where `labels` maps each referenceable label to its equation number
+        (or tag) and section number, and `secno` and `count` are the values
+        at the end of `doc`."""
+        meta, blocks = self._start(doc)
+        self.continue_from(secno, count, {})
+        self._first_pass(blocks, meta, scan(blocks))
+        labels = dict((label, [target.num, target.secno])
+                      for label, target in self.targets.items()
+                      if label not in self.unreferenceable)
+        # The equation count is reset at the first equation in a section, and
+        # so it is stale if the last section has no equations yet
+        secno = pandocxnos.core._sec  # pylint: disable=protected-access
+        count = self.Ntargets \
+          if secno == self.cursec or not self.numbersections else 0
+        return labels, secno, count
+
+    def add_tex(self, meta):
+        """Adds tex to the meta data."""
+
+        warnings = self.warninglevel == 2 and self.targets and \
+          (pandocxnos.cleveref_required() or
+           self.plusname_changed or self.starname_changed or
+           self.numbersections or self.secoffset)
+        if warnings:
+            msg = textwrap.dedent("""\
+                      pandoc-eqnos: Wrote the following blocks to
+                      header-includes.  If you use pandoc's
+                      --include-in-header option then you will need to
+                      manually include these yourself.
+                  """)
+            STDERR.write('\n')
+            STDERR.write(textwrap.fill(msg))
+            STDERR.write('\n')
+
+        # Update the header-includes metadata.  Pandoc's
+        # --include-in-header option will override anything we do here.  This
+        # is a known issue and is owing to a design decision in pandoc.
+        # See https://github.com/jgm/pandoc/issues/3139.
+
+        if pandocxnos.cleveref_required() and self.targets:
+            tex = """
+                %%%% pandoc-eqnos: required package
+                \\usepackage%s{cleveref}
+            """ % ('[capitalise]' if self.capitalise else '')
+            pandocxnos.add_to_header_includes(
+                meta, 'tex', tex,
+                regex=r'\\usepackage(\[[\w\s,]*\])?\{cleveref\}')
+
+            if not self.eqref:
+                pandocxnos.add_to_header_includes(
+                    meta, 'tex', DISABLE_CLEVEREF_BRACKETS_TEX)
+
+        if self.plusname_changed and self.targets:
+            tex = """
+                %%%% pandoc-eqnos: change cref names
+                \\crefname{equation}{%s}{%s}
+            """ % (self.plusname[0], self.plusname[1])
+            pandocxnos.add_to_header_includes(meta, 'tex', tex)
+
+        if self.starname_changed and self.targets:
+            tex = """
+                %%%% pandoc-eqnos: change Cref names
+                \\Crefname{equation}{%s}{%s}
+            """ % (self.starname[0], self.starname[1])
+            pandocxnos.add_to_header_includes(meta, 'tex', tex)
+
+        if self.numbersections and self.targets:
+            pandocxnos.add_to_header_includes(meta, 'tex',
+                                              NUMBER_BY_SECTION_TEX)
+
+        if self.secoffset and self.targets:
+            pandocxnos.add_to_header_includes(
+                meta, 'tex', SECOFFSET_TEX % self.secoffset,
+                regex=r'\\setcounter\{section\}')
+
+        if warnings:
+            STDERR.write('\n')
+
+    def add_html(self, meta, fmt):
+        """Adds html to the meta data."""
+
+        warnings = self.warninglevel == 2 and self.targets
+
+        if warnings:
+            msg = textwrap.dedent("""\
+                      pandoc-eqnos: Wrote the following blocks to
+                      header-includes.  If you use pandoc's
+                      --include-in-header option then you will need to
+                      manually include these yourself.
+                  """)
+            STDERR.write('\n')
+            STDERR.write(textwrap.fill(msg))
+            STDERR.write('\n')
+
+        # Update the header-includes metadata.  Pandoc's
+        # --include-in-header option will override anything we do here.  This
+        # is a known issue and is owing to a design decision in pandoc.
+        # See https://github.com/jgm/pandoc/issues/3139.
+
+        if self.targets:
+            cond = fmt == 'html4' or (fmt == 'html' and self.old_html)
+            attr = ' type="text/css"' if cond else ''
+            pandocxnos.add_to_header_includes(meta, 'html',
+                                              EQUATION_STYLE_HTML%attr)
+
+
+    # Incremental filtering --------------------------------------------------
+
+    def _numbering_state(self):
+        """Returns the numbering state (the section number, the current
+        section, the count of equations in it, the number of made-up labels
+        and the offset for these from a label index) as a list."""
+        # pylint: disable=protected-access
+        return [pandocxnos.core._sec, self.cursec, self.Ntargets,
+                len(self.unreferenceable), self.unreferenceable_offset]
+
+    def _target_list(self, label):
+        """Returns the target for `label` as a list, or None."""
+        target = dict.get(self.targets, label)
+        return list(target) if target else None
+
+    # pylint: disable=too-many-locals, too-many-statements
+    def _filter_incremental(self, blocks, meta):
+        """Numbers the equations and replaces the references in `blocks`
+        one block at a time, reusing the results kept in the state file
+        where they still hold.  Returns the altered blocks."""
+
+        import hashlib  # pylint: disable=import-outside-toplevel
+
+        loads, dumps = get_codec()
+        key = state_key(meta, self.fmt, self.pandocversion)
+        kept = load_state(self.statepath, key)
+        self.targets = _TargetLog(self.targets)
+        flags = scan(blocks)
+        entries = []
+        seen = set()  # Messages given
+        counts = {'blocks': len(blocks), 'renumbered-blocks': 0,
+                  'rereferenced-blocks': 0}
+
+        def give(messages):
+            """Writes the `messages` that weren't given before."""
+            for message in messages:
+                if message not in seen:
+                    seen.add(message)
+                    STDERR.write(message)
+            STDERR.flush()
+
+        # Number the equations.  Blocks with nothing to process are passed
+        # through and aren't kept.  Blocks without equations or headers
+        # don't depend on the numbering state.
+        for block in blocks:
+            if not flags.get(id(block)):
+                entries.append(None)
+                continue
+            numbered = bool(flags[id(block)] & FIRST_PASS)
+            start = self._numbering_state() if numbered else None
+            digest = hashlib.sha1(dumps(block)).hexdigest()
+            entry = kept.get((digest, tuple(start) if numbered else None))
+            if entry is None:
+                entry = {'hash': digest, 'start': start}
+                del self.targets.log[:]
+                stderr = _MessageList()
+                old = _set_stderr(stderr)
+                try:
+                    entry['_blocks'] = \
+                      self._first_pass([block], meta, flags) if numbered \
+                      else [block]
+                finally:
+                    _set_stderr(old)
+                entry['defines'] = [[label] + self._target_list(label)[:2]
+                                    for label in self.targets.log]
+                entry['unreferenceable'] = \
+                  self.unreferenceable[start[3]:] if numbered else []
+                entry['end'] = self._numbering_state() if numbered else None
+                entry['notes1'] = stderr.messages
+                counts['renumbered-blocks'] += 1
+            else:
+                entry = dict(entry)  # Identical blocks may share an entry
+                for label, num, secno in entry['defines']:
+                    self.targets[label] = \
+                      pandocxnos.Target(num, secno, label in self.targets)
+                self.unreferenceable.extend(entry['unreferenceable'])
+                if numbered:
+                    # pylint: disable=protected-access
+                    pandocxnos.core._sec, self.cursec, self.Ntargets = \
+                      entry['end'][:3]
+            give(entry['notes1'])
+            entries.append(entry)
+
+        # Replace the references in the blocks that were numbered again or
+        # whose references' targets changed.  Numbered blocks with references
+        # are kept as they were before this, as it alters them in place.
+        cleveref = self.cleveref
+        altered = []
+        for block, entry in zip(blocks, entries):
+            if entry is None:
+                altered.append(block)
+                continue
+            if 'out' not in entry or \
+              any(self._target_list(label) != target
+                  for label, target in entry['refs'].items()):
+                if '_blocks' in entry:
+                    numbered = entry.pop('_blocks')
+                elif 'first' in entry:  # May be shared; copy it
+                    numbered = loads(dumps(entry['first']))
+                else:
+                    numbered = [block]
+                sites = []
+                bflags = scan(numbered, sites)
+                if entry['start'] is not None and 'first' not in entry and \
+                  any(bflags.get(id(el), 0) & SECOND_PASS for el in numbered):
+                    entry['first'] = loads(dumps(numbered))
+                self.targets.got.clear()
+                pandocxnos.core._cleveref_flag = None  # pylint: disable=W0212
+                mark = len(self.references)
+                stderr = _MessageList()
+                old = _set_stderr(stderr)
+                try:
+                    entry['out'] = \
+                      self._second_pass(numbered, meta, bflags, sites)
+                finally:
+                    _set_stderr(old)
+                entry['references'] = sorted(set(self.references[mark:]))
+                del self.references[mark:]
+                entry['refs'] = dict((label, self._target_list(label))
+                                     for label in self.targets.got)
+                entry['cleveref'] = bool(pandocxnos.cleveref_required())
+                entry['notes2'] = stderr.messages
+                counts['rereferenced-blocks'] += 1
+            cleveref = cleveref or entry['cleveref']
+            self.references.extend(entry['references'])
+            give(entry['notes2'])
+            altered.extend(entry['out'])
+        pandocxnos.core._cleveref_flag = cleveref  # pylint: disable=W0212
+
+        # The state is only written if something changed
+        if counts['renumbered-blocks'] or counts['rereferenced-blocks']:
+            save_state(self.statepath, key,
+                       [entry for entry in entries if entry is not None])
+
+        if self.profile:
+            for name, count in counts.items():
+                self.profile.count(name, count)
+
+        return altered
+
+
+    # Chaining ---------------------------------------------------------------
+
+    def start(self, doc):
+        """Initializes the filter for the document AST `doc`, reading its
+        metadata and any label index.  Returns the document's meta and
+        blocks."""
+        meta, blocks = self._start(doc)
+
+        # Continue from the previous chapters of a book
+        if self.indexpath:
+            self.use_index(load_index(self.indexpath))
+
+        return meta, blocks
+
+    def first_pass_actions(self):
+        """Returns the (actions, post_actions) lists of the pass that numbers
+        the equations."""
+        attach_attrs_math = attach_attrs_factory(Math, allow_space=True)
+        detach_attrs_math = detach_attrs_factory(Math)
+        insert_secnos = insert_secnos_factory(Math)
+        delete_secnos = delete_secnos_factory(Math)
+        return [attach_attrs_math, insert_secnos, self.process_equations,
+                delete_secnos, detach_attrs_math], []
+
+    def second_pass_actions(self):
+        """Returns the (actions, post_actions) lists of the pass that
+        replaces the references.  These must be made after the first pass
+        is done."""
+        process_refs = process_refs_factory(LABEL_PATTERN,
+                                            self.targets.keys())
+        replace_refs = replace_refs_factory(
+            self.targets, self.cleveref, self.eqref,
+            self.plusname if not self.capitalise or self.plusname_changed
+            else [name.title() for name in self.plusname],
+            self.starname)
+        attach_attrs_span = attach_attrs_factory(Span, replace=True)
+        actions = [process_refs, replace_refs]
+        if self.manifestpath or self.depfilepath:
+            actions.insert(1, self.record_references)
+        if not self.api_doc:
+            actions.insert(0, repair_refs)
+        return actions, [attach_attrs_span]
+
+    def add_headers(self, meta):
+        """Adds the blocks needed by the equations to the header-includes in
+        `meta`."""
+        self.renderer.add_headers(meta)
+
+    @staticmethod
+    def owns_label(label):
+        """Returns True if `label` is an equation label."""
+        return bool(LABEL_PATTERN.match(label))
+
+
+    # Multiple formats -------------------------------------------------------
+
+    # pylint: disable=unused-argument
+    def number_equations(self, key, value, fmt, meta):
+        """Numbers the attributed equations without rendering them.  The
+        Equation and target of each are kept in the numbered list."""
+        if key == 'Math' and len(value) == 3:
+            self.Nequations += 1
+            eq = self._process_equation(value, fmt, False)
+            self.numbered.append((eq, self.targets.get(eq.attrs.id)))
+        return None
+
+    def render_equations_factory(self, numbered):
+        """Returns render_equations(key, value, fmt, meta) action that
+        renders the equations numbered by another filter's
+        number_equations(), in the same order, for this filter's output
+        format.  The targets are filled in as the equations are
+        rendered."""
+
+        numbered = iter(numbered)
+        section_tags = self.numbersections and self.renderer.section_tags
+
+        def render_equations(key, value, fmt, meta):
+            """Renders the numbered equations."""
+            if key == 'Math' and len(value) == 3:
+                self.Nequations += 1
+                eq, target = next(numbered)
+                if target is not None:
+                    if section_tags and not eq.is_tagged:
+                        # Hard-code the number by section as a tag
+                        tagged = Equation(eq.attrs)
+                        tagged.is_unreferenceable = eq.is_unreferenceable
+                        tagged.is_tagged = True
+                        eq = tagged
+                        target = pandocxnos.Target(
+                            str(target.secno+self.secoffset) + '.' +
+                            str(target.num), target.secno,
+                            target.has_duplicate)
+                    self.targets[eq.attrs.id] = target
+                return self._render_equation(eq, value)
+            return None
+
+        return render_equations
+
+    def _number(self, blocks, meta, flags):
+        """Numbers the equations in `blocks` for any output format.  Their
+        attributes are left attached.  Returns the altered blocks."""
+        attach_attrs_math = attach_attrs_factory(Math, allow_space=True)
+        insert_secnos = insert_secnos_factory(Math)
+        return self._walk('number', fused_walk, blocks,
+                          [attach_attrs_math, insert_secnos,
+                           self.number_equations], meta, [],
+                          flags, FIRST_PASS)
+
+    def _render(self, blocks, meta, numbered, flags):
+        """Renders the equations in `blocks` numbered by another filter's
+        _number().  Returns the altered blocks."""
+        delete_secnos = delete_secnos_factory(Math)
+        detach_attrs_math = detach_attrs_factory(Math)
+        return self._walk('first', fused_walk, blocks,
+                          [self.render_equations_factory(numbered),
+                           delete_secnos, detach_attrs_math], meta, [],
+                          flags, FIRST_PASS)
+
+
+    # Label manifest ---------------------------------------------------------
+
+    # pylint: disable=unused-argument
+    def record_references(self, key, value, fmt, meta):
+        """Records the labels of the references."""
+        if key == 'Cite' and len(value) == 3:
+            self.references.append(value[-2][0]['citationId'])
+
+    def manifest(self):
+        """Returns the label manifest for the document."""
+        unreferenceable = set(self.unreferenceable)
+        defines = dict((label, list(target[:2]))
+                       for label, target in self.targets.items()
+                       if label not in self.indexed and
+                       label not in unreferenceable)
+        references = {}
+        for label in set(self.references):
+            target = self.targets.get(label)
+            references[label] = list(target[:2]) if target else None
+        return {'pandoc-eqnos-manifest': 1, 'chapter': self.chapter,
+                'defines': defines, 'references': references,
+                'unresolved': sorted(label for label, target in
+                                     references.items() if target is None),
+                'indexed': sorted(self.indexed.intersection(references))}
+
+    def depfile(self, manifest):
+        """Returns a make rule giving the dependencies of the output for
+        the label `manifest`."""
+        target = self.depfiletarget or os.path.splitext(self.depfilepath)[0]
+        prerequisites = []
+        if self.indexpath and (manifest['indexed'] or
+                               (manifest['defines'] and self.continued)):
+            prerequisites.append(self.indexpath)
+        return '%s:%s\n' % (make_escape(target),
+                             ''.join(' ' + make_escape(path)
+                                     for path in prerequisites))
+
+    def write_manifest(self):
+        """Writes the label manifest and/or depfile, if requested."""
+        import json  # pylint: disable=import-outside-toplevel
+        manifest = self.manifest()
+        if self.manifestpath:
+            write_if_changed(self.manifestpath,
+                             json.dumps(manifest, indent=1, sort_keys=True)
+                             .encode('utf-8'))
+        if self.depfilepath:
+            write_if_changed(self.depfilepath,
+                             self.depfile(manifest).encode('utf-8'))
+
+
+    # Processing -------------------------------------------------------------
+
+    def _start(self, doc):
+        """Initializes pandocxnos and reads the metadata of `doc`.  Returns
+        the document's meta and blocks."""
+
+        # Initialize pandocxnos.  This resets its module-level state.
+        self.pandocversion = init_pandocxnos(self.pandocversion, doc)
+        del pandocxnos.badlabels[:]
+
+        # Compare the pandoc version once
+        self.api_doc = version(self.pandocversion) >= version('1.18')
+        self.old_html = version(self.pandocversion) < version('2.0')
+
+        # Chop up the doc
+        meta = doc['meta'] if self.api_doc else doc[0]['unMeta']
+        blocks = doc['blocks'] if self.api_doc else doc[1:]
+
+        # Process the metadata variables
+        self.process(meta)
+
+        return meta, blocks
+
+    def _first_pass(self, blocks, meta, flags):
+        """Numbers the equations in `blocks`.  Returns the altered blocks."""
+        actions, post_actions = self.first_pass_actions()
+        return self._walk('first', fused_walk, blocks, actions, meta,
+                          post_actions, flags, FIRST_PASS)
+
+    def _second_pass(self, blocks, meta, flags, sites=None):
+        """Replaces the references in `blocks`.  Only the reference `sites`
+        from scan() are visited, if they are given.  Returns the altered
+        blocks."""
+        actions, post_actions = self.second_pass_actions()
+
+        # References broken up by older pandocs must be repaired, and these
+        # may be anywhere.  The repaired references are new elements that
+        # scan() didn't flag, and so the flags can't be used.
+        if not self.api_doc:
+            return self._walk('second', fused_walk, blocks, actions, meta,
+                              post_actions)
+        if sites is None:
+            return self._walk('second', fused_walk, blocks, actions, meta,
+                              post_actions, flags, SECOND_PASS)
+
+        self._walk('second', walk_refs, sites, actions, meta, post_actions,
+                   flags)
+        return blocks
+
+    def _filter(self, blocks, meta):
+        """Numbers the equations and replaces the references in `blocks`.
+        Returns the altered blocks."""
+
+        # Find the subtrees and reference sites that need processing
+        sites = []
+        flags = scan(blocks, sites)
+
+        # First pass
+        altered = self._first_pass(blocks, meta, flags)
+
+        # Second pass
+        return self._second_pass(altered, meta, flags, sites)
+
+    # pylint: disable=too-many-arguments
+    def _walk(self, name, walker, x, actions, meta, post_actions, *args):
+        """Walks `x` using `walker` (fused_walk() or walk_refs()), through
+        the profile if there is one.  `name` identifies the pass."""
+        if self.profile:
+            return self.profile.walk(name, walker, x, actions, self.fmt, meta,
+                                     post_actions, *args)
+        return walker(x, actions, self.fmt, meta, post_actions, *args)
+
+    def run(self, doc):
+        """Filters the document AST `doc`.  Returns the altered document."""
+
+        meta, blocks = self.start(doc)
+
+        # The blocks of documents from pandoc < 1.18 are in a single list,
+        # and so these are filtered in full
+        if self.statepath and self.api_doc:
+            altered = self._filter_incremental(blocks, meta)
+        else:
+            altered = self._filter(blocks, meta)
+
+        self.add_headers(meta)
+        if self.manifestpath or self.depfilepath:
+            self.write_manifest()
+
+        # Update the doc
+        if self.api_doc:
+            doc['blocks'] = altered
+        else:
+            doc = doc[:1] + altered
+
+        if self.profile:
+            self.profile.count('equations', self.Nequations)
+            if 'second' in self.profile.passes:
+                self.profile.count('references', self.profile.passes\
+                                   ['second']['actions']['replace_refs']\
+                                   ['replacements'])
+            self.profile.count('bad-references', len(pandocxnos.badlabels))
+
+        return doc
+
+
+# Chaining -------------------------------------------------------------------
+
+# Filters that are always run together (e.g., pandoc-fignos, pandoc-eqnos and
+# pandoc-tablenos) may share a single load of the AST, a single traversal per
+# pass and a single dump.  A unit in the chain is a filter object with the
+# same methods as EqnosFilter:
+#
+#   start(doc) -> (meta, blocks)
+#   first_pass_actions() -> (actions, post_actions)
+#   second_pass_actions() -> (actions, post_actions)
+#   add_headers(meta)
+#   owns_label(label) -> bool
+#
+# The units' chains are concatenated, so that each element is handed from
+# one filter's actions to the next as it would be between successive runs.
+# The units share pandocxnos's module state, which needs two guards.  Every
+# unit's insert_secnos action counts level-1 Headers, and so Headers are
+# hidden from all but the first unit's first pass.  Every unit's
+# replace_refs action replaces any reference with attributes attached, and
+# so a reference is only shown to the second pass of the unit that owns its
+# label.  The cleveref flag is shared, but the units check for an existing
+# cleveref package before adding one to the header-includes.
+#
+# The whole tree is walked by each pass: the flags from scan() describe only
+# equations, and would hide the other filters' elements.  State files and
+# parallel filtering are not used by the chain.
+
+def _hide_headers(actions):
+    """Returns `actions` wrapped so that they pass over Header elements."""
+    def hidden(action):
+        """Returns the wrapped `action`."""
+        def wrapped(key, value, fmt, meta):
+            """Applies the action to all but Header elements."""
+            return None if key == 'Header' else action(key, value, fmt, meta)
+        return wrapped
+    return [hidden(action) for action in actions]
+
+
+def _own_refs(actions, owns_label):
+    """Returns `actions` wrapped so that they pass over references that
+    have attributes attached and a label not accepted by `owns_label`."""
+    def owned(action):
+        """Returns the wrapped `action`."""
+        def wrapped(key, value, fmt, meta):
+            """Applies the action to all but other filters' references."""
+            if key == 'Cite' and len(value) == 3 and \
+              not owns_label(value[-2][0]['citationId']):
+                return None
+            return action(key, value, fmt, meta)
+        return wrapped
+    return [owned(action) for action in actions]
+
+
+def run_chain(doc, units, fmt):
+    """Filters the document AST `doc` with the chain of filter `units` for
+    the output format `fmt`, using one traversal per pass.  Returns the
+    altered document."""
+
+    meta, blocks = None, None
+    for unit in units:
+        meta, blocks = unit.start(doc)
+
+    actions, post_actions = [], []
+    for i, unit in enumerate(units):
+        unit_actions, unit_post_actions = unit.first_pass_actions()
+        actions += _hide_headers(unit_actions) if i else unit_actions
+        post_actions += unit_post_actions
+    blocks = fused_walk(blocks, actions, fmt, meta, post_actions)
+
+    actions, post_actions = [], []
+    for unit in units:
+        unit_actions, unit_post_actions = unit.second_pass_actions()
+        if len(units) > 1:
+            unit_actions = _own_refs(unit_actions, unit.owns_label)
+        actions += unit_actions
+        post_actions += unit_post_actions
+    blocks = fused_walk(blocks, actions, fmt, meta, post_actions)
+
+    for unit in units:
+        unit.add_headers(meta)
+
+    # Update the doc; pandoc < 1.18 documents are lists
+    if isinstance(doc, dict):
+        doc['blocks'] = blocks
+    else:
+        doc = doc[:1] + blocks
+    return doc
+
+
+# Json codecs ----------------------------------------------------------------
+
+# A codec is a (loads, dumps) pair of functions.  loads() takes the json as
+# bytes and returns the document; dumps() takes the document and returns
+# compact json as bytes.  The first available codec in CODEC_PREFERENCE is
+# used unless the PANDOC_EQNOS_JSON environment variable names another.
+
+def _orjson_codec():
+    """Returns the orjson codec.  Raises ImportError if orjson is not
+    installed."""
+    import orjson  # pylint: disable=import-outside-toplevel
+    def dumps(doc):
+        """Serializes `doc` to compact json bytes."""
+        try:
+            return orjson.dumps(doc)
+        except orjson.JSONEncodeError:  # E.g., nested too deeply for orjson
+            return _json_codec()[1](doc)
+    return orjson.loads, dumps
+
+def _json_codec():
+    """Returns the codec built on the standard library's json module."""
+    import json  # pylint: disable=import-outside-toplevel
+    def loads(data):
+        """Parses the json bytes `data`."""
+        return json.loads(data.decode('utf-8'))
+    def dumps(doc):
+        """Serializes `doc` to compact json bytes."""
+        return json.dumps(doc, separators=(',', ':'),
+                          ensure_ascii=False).encode('utf-8')
+    return loads, dumps
+
+CODECS = {'orjson': _orjson_codec, 'json': _json_codec}
+CODEC_PREFERENCE = ['orjson', 'json']
+
+def register_codec(name, factory, preferred=False):
+    """Registers a json codec.  `factory()` must return a (loads, dumps)
+    pair, or raise ImportError if the codec is unavailable."""
+    CODECS[name] = factory
+    if name not in CODEC_PREFERENCE:
+        if preferred:
+            CODEC_PREFERENCE.insert(0, name)
+        else:
+            CODEC_PREFERENCE.insert(-1, name)
+
+def get_codec(name=None):
+    """Returns the (loads, dumps) pair for the codec `name`.  If `name` is
+    None then the preferred available codec is returned."""
+    name = name or os.environ.get('PANDOC_EQNOS_JSON')
+    if name:
+        return CODECS[name]()
+    for name in CODEC_PREFERENCE:
+        try:
+            return CODECS[name]()
+        except ImportError:
+            pass
+    return _json_codec()
+
+
+def read_bytes(stream):
+    """Reads all of `stream` and returns it as bytes."""
+    data = getattr(stream, 'buffer', stream).read()
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return data
+
+def write_bytes(stream, data):
+    """Writes the bytes `data` to `stream` in one call."""
+    buf = getattr(stream, 'buffer', None)
+    if buf is not None:
+        stream.flush()
+        buf.write(data)
+        buf.flush()
+    else:
+        try:
+            stream.write(data)
+        except TypeError:  # A text stream
+            stream.write(data.decode('utf-8'))
+        stream.flush()
+
+
+# Result cache ---------------------------------------------------------------
+
+# The filter's output is determined by the input json (which includes the
+# metadata), the output format, the pandoc version and the filter version.
+# When the PANDOC_EQNOS_CACHE environment variable names a directory,
+# filter_bytes() stores each result there under a hash of these and returns
+# stored results without parsing the document.  Warnings are stored with the
+# results and are repeated on a cache hit.  The directory is kept below
+# PANDOC_EQNOS_CACHE_SIZE bytes (default CACHE_SIZE) by removing the least
+# recently used entries.
+
+CACHE_SIZE = 100*1024*1024
+
+def cache_key(data, fmt, pandocversion=None):
+    """Returns the cache key for filtering the json document `data` (bytes)
+    for the output format `fmt`."""
+    import hashlib  # pylint: disable=import-outside-toplevel
+    pandocversion = pandocversion or os.environ.get('PANDOC_VERSION') or ''
+    h = hashlib.sha256()
+    for part in (__version__, fmt, pandocversion):
+        h.update(part.encode('utf-8') + b'\0')
+    h.update(data)
+    return h.hexdigest()
+
+
+def cache_get(cachedir, key):
+    """Returns the (data, stderr) pair stored for `key` in `cachedir`, or
+    None if there is no such entry."""
+    path = os.path.join(cachedir, key)
+    try:
+        with open(path, 'rb') as f:
+            size = int(f.readline())
+            stderr = f.read(size).decode('utf-8')
+            data = f.read()
+        os.utime(path, None)  # Mark the entry as recently used
+    except (IOError, OSError, ValueError):
+        return None
+    return data, stderr
+
+
+def cache_put(cachedir, key, data, stderr):
+    """Stores the filtered json `data` (bytes) and the `stderr` text for
+    `key` in `cachedir`, and then trims the cache to size."""
+    stderr = stderr.encode('utf-8')
+    path = os.path.join(cachedir, key)
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        with open(tmppath, 'wb') as f:
+            f.write(str(len(stderr)).encode('ascii') + b'\n')
+            f.write(stderr)
+            f.write(data)
+        os.rename(tmppath, path)  # Readers never see partial entries
+        _trim_cache(cachedir, int(os.environ.get('PANDOC_EQNOS_CACHE_SIZE',
+                                                 CACHE_SIZE)))
+    except (IOError, OSError) as e:
+        STDERR.write('\npandoc-eqnos: Could not write cache entry: %s\n' % e)
+        STDERR.flush()
+
+
+def _trim_cache(cachedir, size):
+    """Removes the least recently used entries from `cachedir` until it
+    holds no more than `size` bytes."""
+    entries = []
+    total = 0
+    for name in os.listdir(cachedir):
+        if name.endswith('.tmp'):
+            continue
+        path = os.path.join(cachedir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:  # Removed by another process
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+        total += stat.st_size
+    entries.sort()
+    for _, entrysize, path in entries:
+        if total <= size:
             break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= entrysize
+
+
+class _TeeStream(object):
+    """A text stream that writes to `stream` and keeps a copy."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.parts = []
+
+    def write(self, text):
+        """Writes `text`."""
+        self.parts.append(text)
+        return self.stream.write(text)
 
-    if 'eqnos-plus-name' in meta:
-        tmp = get_meta(meta, 'eqnos-plus-name')
-        old_plusname = copy.deepcopy(plusname)
-        if isinstance(tmp, list):  # The singular and plural forms were given
-            plusname = tmp
-        else:  # Only the singular form was given
-            plusname[0] = tmp
-        plusname_changed = plusname != old_plusname
-        assert len(plusname) == 2
-        for name in plusname:
-            assert isinstance(name, STRTYPES)
-        if plusname_changed:
-            starname = [name.title() for name in plusname]
-
-    if 'eqnos-star-name' in meta:
-        tmp = get_meta(meta, 'eqnos-star-name')
-        old_starname = copy.deepcopy(starname)
-        if isinstance(tmp, list):
-            starname = tmp
+    def flush(self):
+        """Flushes the stream."""
+        self.stream.flush()
+
+    def getvalue(self):
+        """Returns all of the text written so far."""
+        return ''.join(self.parts)
+
+
+# Server ---------------------------------------------------------------------
+
+# Starting a python interpreter and importing this module and its
+# dependencies takes far longer than filtering a typical document.  A
+# long-running server (`pandoc-eqnos --serve SOCKET`) avoids paying this for
+# every document.  When the PANDOC_EQNOS_SOCKET environment variable is set,
+# main() acts as a thin client: it forwards the format, pandoc version and
+# document to the server and writes back the result.  If the server cannot
+# be reached then the document is filtered locally.
+#
+# Protocol: The client sends a json header line with the `fmt` and
+# `pandocversion` followed by the document; it then shuts down writing.  The
+# server replies with a json header line giving the `status` ('ok' or
+# 'error'), any `stderr` output and an error `message`, followed by the
+# filtered document.
+#
+# Requests are handled one at a time by a fresh EqnosFilter, so that no
+# state is shared between documents.  The server stops on SIGINT or SIGTERM,
+# removing its socket.
+
+def _set_stderr(stream):
+    """Redirects this module's and pandocxnos's stderr to `stream`.  Returns
+    the stream that was replaced."""
+    global STDERR  # pylint: disable=global-statement
+    old = STDERR
+    STDERR = stream
+    if 'pandocxnos.core' in sys.modules:
+        sys.modules['pandocxnos.core'].STDERR = stream
+    return old
+
+
+def filter_captured(data, fmt, pandocversion=None):
+    """Filters the json document `data` (bytes) as filter_bytes() does, but
+    captures stderr and any exception.  Returns the tuple (data, error,
+    stderr), where `data` is None and `error` is the traceback if the filter
+    failed."""
+    stderr = io.StringIO()
+    old = _set_stderr(stderr)
+    try:
+        return filter_bytes(data, fmt, pandocversion), None, stderr.getvalue()
+    except Exception:  # pylint: disable=broad-except
+        import traceback  # pylint: disable=import-outside-toplevel
+        return None, traceback.format_exc(), stderr.getvalue()
+    finally:
+        _set_stderr(old)
+
+
+def serve(path):
+    """Serves filter requests on the unix socket at `path`."""
+
+    # pylint: disable=import-outside-toplevel
+    import json
+    import signal
+    import socket
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        """Handles a filter request."""
+
+        def handle(self):
+            """Filters the document in the request."""
+            header = json.loads(self.rfile.readline().decode('utf-8'))
+            data, error, stderr = filter_captured(
+                self.rfile.read(), header['fmt'], header.get('pandocversion'))
+            reply = {'status': 'error' if error else 'ok',
+                     'message': error, 'stderr': stderr}
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+            self.wfile.write(data or b'')
+
+    # Remove a stale socket
+    if os.path.exists(path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except socket.error:
+            os.unlink(path)
         else:
-            starname[0] = tmp
-        starname_changed = starname != old_starname
-        assert len(starname) == 2
-        for name in starname:
-            assert isinstance(name, STRTYPES)
-
-    for name in ['eqnos-number-by-section', 'xnos-number-by-section']:
-        if name in meta:
-            numbersections = check_bool(get_meta(meta, name))
+            raise RuntimeError('pandoc-eqnos: Server already running on %s'
+                               % path)
+        finally:
+            sock.close()
+
+    def terminate(signum, frame):  # pylint: disable=unused-argument
+        """Stops the server, so that the socket is removed."""
+        raise SystemExit(0)
+
+    server = socketserver.UnixStreamServer(path, Handler)
+    handler = signal.getsignal(signal.SIGTERM)
+    try:
+        signal.signal(signal.SIGTERM, terminate)
+        STDERR.write('pandoc-eqnos: Serving on %s\n' % path)
+        STDERR.flush()
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, handler)
+        server.server_close()
+        os.unlink(path)
+
+
+def request(path, data, fmt, pandocversion=None):
+    """Sends the json document `data` (bytes) to the server at `path` for
+    filtering.  Returns the reply header dict and the filtered document.
+    Raises socket.error if the server cannot be reached, and ValueError if
+    the reply is empty or garbled."""
+
+    # pylint: disable=import-outside-toplevel
+    import json
+    import socket
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        header = {'fmt': fmt, 'pandocversion': pandocversion}
+        sock.sendall(json.dumps(header).encode('utf-8') + b'\n')
+        sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = sock.recv(1 << 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+    reply = b''.join(chunks)
+    header, _, data = reply.partition(b'\n')
+    header = json.loads(header.decode('utf-8'))
+    if not isinstance(header, dict) or \
+      not {'status', 'message', 'stderr'} <= set(header):
+        raise ValueError('Bad reply header: %r' % header)
+    return header, data
+
+
+# Batch processing -----------------------------------------------------------
+
+# `pandoc-eqnos batch FMT [FILE ...]` filters many documents in parallel
+# across a pool of worker processes.  The documents are either json files
+# (written to an output directory) or json lines read from stdin (written as
+# json lines to stdout).  Results are returned in the input order.  A
+# failure affects only its own document; for json lines, the failed
+# document's line is replaced by an object with a "pandoc-eqnos-error" key.
+
+def _filter_task(task):
+    """Filters a document in a worker process.  `task` is the tuple (name,
+    data, fmt, pandocversion).  Returns the name followed by the results from
+    filter_captured()."""
+    name, data, fmt, pandocversion = task
+
+    # Documents that are passed through aren't parsed by the filter, and so
+    # check that they are json documents
+    if is_passthrough(data):
+        try:
+            doc = get_codec()[0](data)
+        except ValueError as e:
+            return name, None, 'Invalid json: %s\n' % e, ''
+        if not isinstance(doc, (dict, list)):
+            return name, None, 'Not a pandoc json document\n', ''
+
+    return (name,) + filter_captured(data, fmt, pandocversion)
+
+
+def _file_tasks(paths, fmt, pandocversion):
+    """Yields filter tasks for the json files at `paths`."""
+    for path in paths:
+        with open(path, 'rb') as f:
+            yield path, f.read(), fmt, pandocversion
+
+
+def _line_tasks(stream, fmt, pandocversion):
+    """Yields filter tasks for the json lines in `stream`."""
+    for n, line in enumerate(getattr(stream, 'buffer', stream)):
+        line = line.strip()
+        if line:
+            yield 'line %d' % (n+1), line, fmt, pandocversion
+
+
+def batch(argv=None, stdin=STDIN, stdout=STDOUT):
+    """Filters many documents in parallel.  Returns the number of documents
+    that failed."""
+
+    # pylint: disable=import-outside-toplevel
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(
+        prog='pandoc-eqnos batch',
+        description='Filters many pandoc json documents in parallel.')
+    parser.add_argument('fmt')
+    parser.add_argument('files', nargs='*',
+                        help='Json files to filter.  If none are given then '
+                        'json lines are read from stdin.')
+    parser.add_argument('-o', '--output-dir',
+                        help='Directory for the filtered json files.')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='Number of worker processes (default: one per '
+                        'cpu).')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='Only report documents that have problems.')
+    parser.add_argument('--pandocversion', help='The pandoc version.')
+    args = getattr(parser, 'parse_intermixed_args', parser.parse_args)(argv)
+
+    if args.files:
+        if not args.output_dir:
+            parser.error('--output-dir is required when files are given')
+        for path in args.files:
+            if os.path.dirname(os.path.abspath(path)) == \
+              os.path.abspath(args.output_dir):
+                parser.error('%s would be overwritten' % path)
+        names = [os.path.basename(path) for path in args.files]
+        if len(set(names)) < len(names):
+            parser.error('file names must be unique, as the outputs are '
+                         'named after them')
+        tasks = _file_tasks(args.files, args.fmt, args.pandocversion)
+    else:
+        tasks = _line_tasks(stdin, args.fmt, args.pandocversion)
+    out = getattr(stdout, 'buffer', stdout)
+
+    pool = None
+    if args.jobs == 1:
+        results = (_filter_task(task) for task in tasks)
+    else:
+        import multiprocessing  # pylint: disable=import-outside-toplevel
+        pool = multiprocessing.Pool(args.jobs)
+        results = pool.imap(_filter_task, tasks)
+
+    count, failures = 0, 0
+    try:
+        for name, data, error, stderr in results:
+            count += 1
+            if error:
+                failures += 1
+            if error or stderr or not args.quiet:
+                STDERR.write('pandoc-eqnos: %s: %s\n' %
+                             (name, 'failed' if error else 'ok'))
+                STDERR.write(stderr)
+                STDERR.write(error or '')
+                STDERR.flush()
+            if args.files:
+                if data is not None:
+                    path = os.path.join(args.output_dir,
+                                        os.path.basename(name))
+                    with open(path, 'wb') as f:
+                        f.write(data)
+            else:
+                if data is None:
+                    data = json.dumps({'pandoc-eqnos-error': error})\
+                      .encode('utf-8')
+                out.write(data + b'\n')
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    out.flush()
+
+    STDERR.write('pandoc-eqnos: Filtered %d documents; %d failed.\n' %
+                 (count, failures))
+    STDERR.flush()
+    return failures
+
+
+# Label index ----------------------------------------------------------------
+
+# A book split into chapter documents can be filtered one chapter at a time
+# (e.g., in parallel) using a label index.  `pandoc-eqnos index FMT FILE ...`
+# numbers the equations in the chapters' json files, in book order, and
+# writes the labels, numbers and section numbers to an index file.  This
+# pass doesn't filter the references and so it is fast.  Each chapter is then
+# filtered with the `eqnos-index` meta variable set to the index path and
+# `eqnos-index-chapter` set to the chapter's name (its file name without the
+# extension).  Its numbering continues from the previous chapters and
+# references to the other chapters' labels are resolved.
+#
+# Index format: {"pandoc-eqnos-index": 1, "fmt": FMT, "chapters": [CHAPTER,
+# ...]}, where each CHAPTER is {"name": NAME, "secno": SECNO, "count": COUNT,
+# "labels": {LABEL: [NUM, SECNO], ...}} and SECNO and COUNT give the section
+# number and equation count at the start of the chapter.
+
+def build_index(paths, fmt, pandocversion=None):
+    """Numbers the equations in the json chapter files at `paths`, in
+    order.  Returns the label index."""
+    loads, _ = get_codec()
+    chapters = []
+    secno, count, unreferenceable = 0, 0, 0
+    for path in paths:
+        with open(path, 'rb') as f:
+            doc = loads(f.read())
+        name = os.path.splitext(os.path.basename(path))[0]
+        chapter = {'name': name, 'secno': secno, 'count': count,
+                   'unreferenceable': unreferenceable}
+        eqnos = EqnosFilter(fmt, pandocversion)
+        chapter['labels'], secno, count = eqnos.index(doc, secno, count)
+        unreferenceable += len(eqnos.unreferenceable)
+        chapters.append(chapter)
+    return {'pandoc-eqnos-index': 1, 'fmt': fmt, 'chapters': chapters}
+
+
+def load_index(path):
+    """Reads the label index at `path`."""
+    loads, _ = get_codec()
+    with open(path, 'rb') as f:
+        labelindex = loads(f.read())
+    if labelindex.get('pandoc-eqnos-index') != 1:
+        raise RuntimeError('pandoc-eqnos: %s is not a label index' % path)
+    return labelindex
+
+
+def index(argv=None):
+    """Writes a label index for the chapters of a book.  Returns 0."""
+
+    import argparse  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(
+        prog='pandoc-eqnos index',
+        description='Indexes the equation labels in the pandoc json files '
+        'for the chapters of a book.')
+    parser.add_argument('fmt')
+    parser.add_argument('files', nargs='+',
+                        help='Json files for the chapters, in book order.')
+    parser.add_argument('-o', '--output', required=True,
+                        help='Path for the index.')
+    parser.add_argument('--pandocversion', help='The pandoc version.')
+    args = getattr(parser, 'parse_intermixed_args', parser.parse_args)(argv)
+
+    names = [os.path.splitext(os.path.basename(path))[0]
+             for path in args.files]
+    if len(set(names)) < len(names):
+        parser.error('chapter names (file names without extensions) must '
+                     'be unique')
+
+    data = get_codec()[1](build_index(args.files, args.fmt,
+                                      args.pandocversion))
+    with open(args.output, 'wb') as f:
+        f.write(data)
+    return 0
+
+
+# Label manifest -------------------------------------------------------------
+
+# A build system can avoid rebuilding a document's outputs when the labels it
+# depends on haven't changed.  When the `eqnos-manifest` meta variable gives
+# a path, a json manifest is written there that lists the labels defined by
+# the document with their targets, the labels it references with theirs, the
+# references that weren't resolved and the references resolved from other
+# chapters in a label index.  When `eqnos-depfile` gives a path, a make rule
+# is written there.  Its target is `eqnos-depfile-target`, or else the
+# depfile's path without its extension (e.g., `ch2.html` for `ch2.html.d`).
+# The label index is its prerequisite only if the document references labels
+# in other chapters or continues their numbering.  Both files are rewritten
+# only when their contents change, and so their times may be used as stamps.
+#
+# Manifest format: {"pandoc-eqnos-manifest": 1, "chapter": NAME, "defines":
+# {LABEL: [NUM, SECNO], ...}, "references": {LABEL: [NUM, SECNO] or null,
+# ...}, "unresolved": [LABEL, ...], "indexed": [LABEL, ...]}
+
+def make_escape(path):
+    """Escapes `path` for a make rule."""
+    return path.replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ')
+
+
+def write_if_changed(path, data):
+    """Writes the bytes `data` to the file at `path`, unless it already
+    holds them."""
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return
+    except (IOError, OSError):
+        pass
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmppath, 'wb') as f:
+            f.write(data)
+        os.rename(tmppath, path)
+    except (IOError, OSError) as e:
+        STDERR.write('\npandoc-eqnos: Could not write %s: %s\n' % (path, e))
+        STDERR.flush()
+
+
+# Incremental filtering ------------------------------------------------------
+
+# A document that is filtered again after each edit (e.g., for a live preview)
+# may be filtered incrementally by setting the `eqnos-state` meta variable to
+# the path of a state file.  For each top-level block, the state keeps a hash
+# of its json, the numbering state before and after it, the targets it
+# defines, the targets of the labels it references, its filtered json and the
+# warnings given for it.  When the document is filtered again, a block is
+# numbered again only if its hash changed or, for blocks with equations or
+# headers, if the numbering state before it changed.  Its references are
+# replaced again only if it was numbered again or if any of its references'
+# targets changed.  Everything else is taken from the state.  The state is
+# discarded if the filter version, output format, pandoc version or metadata
+# changed.
+#
+# State format: {"pandoc-eqnos-state": 1, "key": KEY, "blocks": [ENTRY, ...]}
+
+class _TargetLog(dict):
+    """A targets dict that logs the labels that are set and looked up."""
+
+    def __init__(self, targets):
+        dict.__init__(self, targets)
+        self.log = []     # Labels set
+        self.got = set()  # Labels looked up
+
+    def __setitem__(self, label, target):
+        self.log.append(label)
+        dict.__setitem__(self, label, target)
+
+    def __contains__(self, label):
+        self.got.add(label)
+        return dict.__contains__(self, label)
+
+
+def state_key(meta, fmt, pandocversion):
+    """Returns the key for the state of filtering documents with the
+    metadata `meta` for the output format `fmt`."""
+    import hashlib  # pylint: disable=import-outside-toplevel
+    h = hashlib.sha256()
+    for part in (__version__, fmt, pandocversion or ''):
+        h.update(part.encode('utf-8') + b'\0')
+    h.update(get_codec()[1](meta))
+    return h.hexdigest()
+
+
+def load_state(path, key):
+    """Reads the state file at `path`.  Returns a dict that maps the hash and
+    starting numbering state of each block to its entry.  The dict is empty
+    if there is no state for `key`."""
+    try:
+        with open(path, 'rb') as f:
+            state = get_codec()[0](f.read())
+    except (IOError, OSError, ValueError):
+        return {}
+    if not isinstance(state, dict) or \
+      state.get('pandoc-eqnos-state') != 1 or state.get('key') != key:
+        return {}
+    return dict(((entry['hash'], tuple(entry['start'])
+                  if entry['start'] is not None else None), entry)
+                for entry in state['blocks'])
+
+
+def save_state(path, key, entries):
+    """Writes the block `entries` to the state file at `path`."""
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmppath, 'wb') as f:
+            f.write(get_codec()[1]({'pandoc-eqnos-state': 1, 'key': key,
+                                    'blocks': entries}))
+        os.rename(tmppath, path)  # Readers never see a partial state
+    except (IOError, OSError) as e:
+        STDERR.write('\npandoc-eqnos: Could not write state file: %s\n' % e)
+        STDERR.flush()
+
+
+# Parallel processing --------------------------------------------------------
+
+# A very large document may be filtered across a pool of worker processes by
+# setting the PANDOC_EQNOS_JOBS environment variable to the number of
+# workers.  Documents smaller than PANDOC_EQNOS_PARALLEL_SIZE bytes (default
+# PARALLEL_SIZE) are filtered serially, as starting the workers and passing
+# the chunks to them would cost more than it saves.  So are documents that use
+# a label index or a state file.
+#
+# The document's blocks are split into one chunk per worker, and the chunks
+# are processed in two rounds:
+#
+#   1. Each chunk's equations are numbered as if the chunk were a document
+#      of its own.  Prefix sums over the chunks' section and equation counts
+#      give the numbering state at the start of each chunk, from which the
+#      chunk-local numbers are made global.  The result is a label index
+#      with an entry for each chunk (see Label index, above).
+#
+#   2. Each chunk is filtered using the label index, which continues its
+#      numbering from the previous chunks and resolves its references to the
+#      others' labels.
+#
+# As when filtering serially, a label that is defined more than once refers
+# to its last definition, which may be in a later chunk.  The header-includes
+# are then added once for the whole document.  Each worker has its own copy
+# of pandocxnos's module-level state.  The chunks are passed to and from the
+# workers as json, and the filtered chunks are joined without parsing them
+# again.  The workers' warnings are repeated in chunk order.  Warnings about
+# the metadata are given once by the main process, and a bad reference is
+# reported only for its first occurrence, as pandocxnos does.
+
+PARALLEL_SIZE = 1 << 23
+
+# Matches pandocxnos's warning for a bad reference
+BAD_REFERENCE_PATTERN = re.compile(r'\n\S+: Bad reference: @(\S+)\.\n$')
+
+
+class _MessageList(object):
+    """A stream that keeps the messages written to it."""
+
+    def __init__(self):
+        self.messages = []
+
+    def write(self, text):
+        """Keeps `text`."""
+        self.messages.append(text)
+
+    def flush(self):
+        """Does nothing."""
+
+
+def _number_chunk(task):
+    """Numbers the equations in a chunk in a worker process.  `task` is the
+    tuple (data, fmt, pandocversion), where `data` is the chunk as a json
+    document.  Returns the tuple (labels, secno, count, unreferenceable)
+    from numbering the chunk on its own; untagged equations are given their
+    counts rather than section tags."""
+    data, fmt, pandocversion = task
+    old = _set_stderr(_MessageList())  # Warnings are given in round 2
+    try:
+        eqnos = EqnosFilter(fmt, pandocversion)
+        eqnos.renderer.section_tags = False  # Tags are made once numbered
+        labels, secno, count = eqnos.index(get_codec()[0](data))
+        return labels, secno, count, len(eqnos.unreferenceable)
+    finally:
+        _set_stderr(old)
+
+
+def _filter_chunk(task):
+    """Filters a chunk in a worker process.  `task` is the tuple (name, data,
+    labelindex, fmt, pandocversion), where `data` is the chunk as a json
+    document and `labelindex` is json.  Returns the tuple (data, messages,
+    unreferenced, cleveref, nequations), where `data` is the chunk's filtered
+    blocks as json, `messages` are its warnings, `unreferenced` gives the
+    targets of its unreferenceable equations, `cleveref` flags that the
+    cleveref package is needed and `nequations` is the number of equations
+    processed."""
+    name, data, labelindex, fmt, pandocversion = task
+    loads, dumps = get_codec()
+    labelindex = loads(labelindex)
+    old = _set_stderr(_MessageList())  # The main process gives these
+    stderr = _MessageList()
+    # pylint: disable=protected-access
+    try:
+        eqnos = EqnosFilter(fmt, pandocversion)
+        meta, blocks = eqnos._start(loads(data))
+        _set_stderr(stderr)
+        eqnos.chapter = name
+        eqnos.use_index(labelindex)
+
+        # Keep the targets of the labels defined in later chunks, so that
+        # they can't be replaced by this chunk's definitions
+        names = [chapter['name'] for chapter in labelindex['chapters']]
+        later = dict((label, eqnos.targets[label]) for chapter in
+                     labelindex['chapters'][names.index(name)+1:]
+                     for label in chapter['labels'])
+
+        sites = []
+        flags = scan(blocks, sites)
+        blocks = eqnos._first_pass(blocks, meta, flags)
+        for label, target in later.items():
+            eqnos.targets[label] = target
+        data = dumps(eqnos._second_pass(blocks, meta, flags, sites))
+        unreferenced = [(label, tuple(eqnos.targets[label]))
+                        for label in eqnos.unreferenceable]
+        return data, stderr.messages, unreferenced, \
+          pandocxnos.cleveref_required(), eqnos.Nequations
+    finally:
+        _set_stderr(old)
+
+
+def chunk_index(summaries, numbersections=False, section_tags=False,
+                secoffset=0):
+    """Returns a label index for the chunks of a document, given a
+    `summaries` list of the results from numbering each chunk on its own.
+    Equation numbers are given by section if `numbersections` is True;
+    untagged equations are then given section tags if `section_tags` is
+    True, starting from the section number offset `secoffset`."""
+    chapters = []
+    secno, count, unreferenceable = 0, 0, 0
+    for n, (labels, nsecs, ncount, nunreferenceable) in enumerate(summaries):
+        for num_secno in labels.values():
+            num, sec = num_secno
+            if isinstance(num, int):  # An untagged equation's count
+                if sec == 0 or not numbersections:  # Continues the count
+                    num += count
+                if numbersections and section_tags:
+                    num = str(secno+sec+secoffset) + '.' + str(num)
+            num_secno[:] = [num, secno+sec]
+        chapters.append({'name': str(n), 'secno': secno, 'count': count,
+                         'unreferenceable': unreferenceable,
+                         'labels': labels})
+        count = ncount if numbersections and nsecs else count + ncount
+        secno += nsecs
+        unreferenceable += nunreferenceable
+    return {'pandoc-eqnos-index': 1, 'chapters': chapters}
+
+
+# pylint: disable=too-many-locals
+def filter_parallel(doc, fmt, pandocversion=None, jobs=2, profile=None):
+    """Filters the document AST `doc` for the output format `fmt` using
+    `jobs` worker processes.  Timings and counts are collected in `profile`,
+    if it is given.  Returns the filtered json as bytes."""
+
+    import multiprocessing  # pylint: disable=import-outside-toplevel
+
+    loads, dumps = get_codec()
+    def timed(name, func, *args):
+        """Calls `func(*args)`, timing it if profiling."""
+        return profile.timed(name, func, *args) if profile else func(*args)
+
+    # Pandoc < 1.18 documents are lists and are filtered serially
+    eqnos = EqnosFilter(fmt, pandocversion, profile)
+    if not isinstance(doc, dict):
+        return dumps(eqnos.run(doc))
+
+    meta, blocks = eqnos._start(doc)  # pylint: disable=protected-access
+
+    # Split the blocks into chunks, freeing them as they are serialized
+    size = -(-len(blocks) // jobs)
+    chunks = []
+    while blocks:
+        chunks.append(dumps(dict(doc, blocks=blocks[:size])))
+        del blocks[:size]
+
+    pool = multiprocessing.Pool(min(jobs, len(chunks)) or 1)
+    try:
+        summaries = timed('number-chunks', pool.map, _number_chunk,
+                          [(chunk, fmt, eqnos.pandocversion)
+                           for chunk in chunks], 1)
+        labelindex = chunk_index(summaries, eqnos.numbersections,
+                                 eqnos.renderer.section_tags,
+                                 eqnos.secoffset)
+        data = dumps(labelindex)
+        results = timed('filter-chunks', pool.map, _filter_chunk,
+                        [(str(n), chunk, data, fmt, eqnos.pandocversion)
+                         for n, chunk in enumerate(chunks)], 1)
+    finally:
+        pool.close()
+        pool.join()
+    del chunks
+
+    # Give the workers' warnings and merge their state
+    for chapter in labelindex['chapters']:
+        for label, (num, secno) in chapter['labels'].items():
+            eqnos.targets[label] = pandocxnos.Target(num, secno,
+                                                     label in eqnos.targets)
+    badlabels = set()
+    for _, messages, unreferenced, cleveref, nequations in results:
+        for message in messages:
+            match = BAD_REFERENCE_PATTERN.match(message)
+            if match:
+                if match.group(1) in badlabels:
+                    continue
+                badlabels.add(match.group(1))
+            STDERR.write(message)
+        for label, target in unreferenced:
+            eqnos.unreferenceable.append(label)
+            eqnos.targets[label] = pandocxnos.Target(*target)
+        if cleveref:
+            pandocxnos.core._cleveref_flag = True  # pylint: disable=W0212
+        eqnos.Nequations += nequations
+    STDERR.flush()
+    eqnos.renderer.add_headers(meta)
+
+    if profile:
+        profile.count('chunks', len(results))
+        profile.count('equations', eqnos.Nequations)
+
+    # Join the filtered chunks without parsing them
+    parts = [result[0].strip()[1:-1].strip() for result in results]
+    blocks = b'[' + b','.join(part for part in parts if part) + b']'
+    return b'{' + b','.join(dumps(key) + b':' + \
+                            (blocks if key == 'blocks' else dumps(value))
+                            for key, value in doc.items()) + b'}'
+
+
+# Streaming ------------------------------------------------------------------
+
+# A document too large to be held in memory as a python object tree may be
+# filtered from a json file using `pandoc-eqnos stream FMT FILE -o OUTPUT`.
+# The file is memory-mapped and its top-level blocks are parsed one at a time
+# from a decoded window of it.  The blocks are read in two passes, a batch of
+# about STREAM_BATCH bytes at a time.  The first pass numbers the
+# equations to find the targets.  The second pass numbers the equations again
+# (giving the same numbers), replaces the references, and writes out the
+# altered blocks as it goes.  The memory used is bounded by the largest batch
+# (or block) and the targets.
+#
+# The metadata is written after the blocks, as the header-includes aren't
+# known until all of the references are replaced.  Pandoc doesn't mind the
+# order.  Only json from pandoc 1.18 or later can be streamed.
+
+STREAM_BATCH = 1 << 20
+
+_SPACE_PATTERN = re.compile(r'\s*')
+
+class _JsonReader(object):
+    """Reads json values one at a time from a bytes-like buffer (e.g., a
+    memory map), decoding a window of it at a time.  The values are parsed
+    using the standard library's json module, as the codecs can only parse
+    whole documents."""
+
+    def __init__(self, buf, pos=0):
+        import codecs  # pylint: disable=import-outside-toplevel
+        import json  # pylint: disable=import-outside-toplevel
+        self.buf = buf
+        self.pos = pos   # Position in buf after the window
+        self.text = ''   # The decoded window
+        self.i = 0       # Position in the window
+        self.size = STREAM_BATCH  # Bytes to decode at a time
+        self.consumed = 0         # Characters parsed as values
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+
+    def _fill(self):
+        """Adds the next bytes of the buffer to the window.  Returns False
+        if there are none."""
+        if self.pos >= len(self.buf):
+            return False
+        data = self.buf[self.pos:self.pos+self.size]
+        self.pos += len(data)
+        self.text = self.text[self.i:] + \
+          self.utf8.decode(data, self.pos >= len(self.buf))
+        self.i = 0
+        return True
+
+    def offset(self):
+        """Returns the position in the buffer of the next character."""
+        return self.pos - len(self.text[self.i:].encode('utf-8')) - \
+          len(self.utf8.getstate()[0])
+
+    def peek(self):
+        """Skips space and returns the next character, or '' at the end."""
+        while True:
+            self.i = _SPACE_PATTERN.match(self.text, self.i).end()
+            if self.i < len(self.text):
+                return self.text[self.i]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        """Reads the next character, which must be one of `chars`.  Returns
+        the character."""
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError('pandoc-eqnos: Bad json at byte %d' % \
+                             self.offset())
+        self.i += 1
+        return c
+
+    def value(self):
+        """Reads the next json value.  Returns the value."""
+        self.peek()
+        while True:
+            # A value that runs to the end of the window may be truncated
+            try:
+                value, end = self.decoder.raw_decode(self.text, self.i)
+            except ValueError:
+                end = None
+            if end is not None and end < len(self.text):
+                break
+            if not self._fill():
+                if end is None:
+                    raise ValueError('pandoc-eqnos: Bad json at byte %d' % \
+                                     self.offset())
+                break
+            self.size *= 2  # Keep parsing a large value from going quadratic
+        self.consumed += end - self.i
+        self.i = end
+        return value
+
+    def items(self):
+        """Generates the values in the json array that is read next."""
+        self.expect('[')
+        if self.peek() == ']':
+            self.i += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+
+def read_head(buf):
+    """Reads the top level of the json document in `buf`.  Returns the
+    document with an empty list of blocks, and the position of the blocks in
+    `buf`.  Reading stops at the blocks if the metadata came before them, as
+    in pandoc's output; otherwise the blocks are read past."""
+    reader = _JsonReader(buf)
+    if reader.expect('{[') == '[':
+        raise ValueError('pandoc-eqnos: Only json from pandoc 1.18 or '
+                         'later can be streamed')
+    doc, blocks = {}, None
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key == 'blocks':
+            doc[key], blocks = [], reader.offset()
+            if 'meta' in doc:
+                break
+            for _ in reader.items():
+                pass
+        else:
+            doc[key] = reader.value()
+        if reader.expect(',}') == '}':
             break
+    if blocks is None:
+        raise ValueError('pandoc-eqnos: The json has no blocks')
+    return doc, blocks
+
+
+def _batches(buf, pos):
+    """Generates the top-level blocks in the json array at `pos` in `buf`,
+    in lists read from about STREAM_BATCH bytes (or one block) each."""
+    reader = _JsonReader(buf, pos)
+    blocks = []
+    for block in reader.items():
+        blocks.append(block)
+        if reader.consumed >= STREAM_BATCH:
+            yield blocks
+            blocks, reader.consumed = [], 0
+    if blocks:
+        yield blocks
+
+
+def filter_stream(path, fmt, pandocversion, out):
+    """Filters the json document in the file at `path` for the output format
+    `fmt`, writing the result to the binary stream `out`.  Returns the number
+    of blocks."""
+
+    import mmap  # pylint: disable=import-outside-toplevel
+
+    _, dumps = get_codec()
+
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        doc, pos = read_head(buf)
+
+        # First pass: find the targets
+        eqnos = EqnosFilter(fmt, pandocversion)
+        meta, _ = eqnos._start(doc)  # pylint: disable=protected-access
+        if eqnos.indexpath:
+            eqnos.use_index(load_index(eqnos.indexpath))
+        for blocks in _batches(buf, pos):
+            # pylint: disable=protected-access
+            eqnos._first_pass(blocks, meta, scan(blocks))
+        targets = eqnos.targets
+
+        # Second pass: number the equations again with a fresh filter, and
+        # replace the references using the targets from the first pass.
+        # The warnings given by the first pass aren't repeated.
+        eqnos = EqnosFilter(fmt, pandocversion)
+        old = _set_stderr(_MessageList())
+        try:
+            meta, _ = eqnos._start(doc)  # pylint: disable=protected-access
+            if eqnos.indexpath:
+                eqnos.use_index(load_index(eqnos.indexpath))
+        finally:
+            _set_stderr(old)
+
+        out.write(b'{' + b''.join(dumps(key) + b':' + dumps(value) + b','
+                                  for key, value in doc.items()
+                                  if key not in ('blocks', 'meta')) +
+                  b'"blocks":[')
+        n = 0
+        cleveref = False
+        for blocks in _batches(buf, pos):
+            # pylint: disable=protected-access
+            sites = []
+            flags = scan(blocks, sites)
+            eqnos.targets = TargetTable()
+            old = _set_stderr(_MessageList())
+            try:
+                blocks = eqnos._first_pass(blocks, meta, flags)
+            finally:
+                _set_stderr(old)
+            eqnos.targets = targets
+            blocks = eqnos._second_pass(blocks, meta, flags, sites)
+            # The clever references flag is reset for each batch
+            cleveref = cleveref or bool(pandocxnos.cleveref_required())
+            for block in blocks:
+                out.write(b',' + dumps(block) if n else dumps(block))
+                n += 1
+        pandocxnos.core._cleveref_flag = cleveref  # pylint: disable=W0212
+
+        eqnos.renderer.add_headers(meta)
+        if eqnos.manifestpath or eqnos.depfilepath:
+            eqnos.write_manifest()
+        out.write(b'],"meta":' + dumps(meta) + b'}')
+    finally:
+        buf.close()
+
+    return n
+
+
+def stream(argv=None):
+    """Filters a json file too large to be held in memory.  Returns 0."""
+
+    import argparse  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(
+        prog='pandoc-eqnos stream',
+        description='Filters a large pandoc json file in two streaming '
+        'passes.')
+    parser.add_argument('fmt')
+    parser.add_argument('file', help='Json file to filter.')
+    parser.add_argument('-o', '--output',
+                        help='Path for the filtered json (default: stdout).')
+    parser.add_argument('--pandocversion', help='The pandoc version.')
+    args = parser.parse_args(argv)
+
+    if args.output:
+        tmppath = '%s.%d.tmp' % (args.output, os.getpid())
+        try:
+            with open(tmppath, 'wb') as f:
+                filter_stream(args.file, args.fmt, args.pandocversion, f)
+            os.rename(tmppath, args.output)
+        finally:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+    else:
+        out = getattr(STDOUT, 'buffer', STDOUT)
+        filter_stream(args.file, args.fmt, args.pandocversion, out)
+        out.flush()
+    return 0
+
+
+# Multiple formats -----------------------------------------------------------
+
+# A document that is published in several formats needs its equations
+# numbered and its labels resolved only once.  filter_formats() numbers the
+# equations for any format, leaving their attributes attached.  For each
+# format, the numbering is then replayed as the equations are rendered, and
+# the references are replaced; equation numbers by section are hard-coded as
+# tags for the formats that need this as the numbering is replayed.  The
+# references are still replaced for each format, as their content depends
+# on it.
+#
+# Only the top-level blocks flagged by scan() are altered for a format, and
+# so only these (and the metadata) are copied for each format.  The other
+# blocks are shared by the outputs.  Old documents (pandoc < 1.18) and
+# documents that use a label index or a state file are filtered in full for
+# each format.
+
+def filter_formats(data, fmts, pandocversion=None):
+    """Filters the json document `data` (bytes) for each of the output
+    formats `fmts`, numbering the equations once.  Returns a list of (data,
+    error, stderr) tuples as given by filter_captured(), one per format."""
+
+    if len(fmts) < 2 or is_passthrough(data) or b'eqnos-index' in data or \
+      b'eqnos-state' in data:
+        return [filter_captured(data, fmt, pandocversion) for fmt in fmts]
+
+    import traceback  # pylint: disable=import-outside-toplevel
+
+    loads, dumps = get_codec()
+
+    # Number the equations.  As when each format is filtered in full, the
+    # metadata warnings and the warnings from numbering are given for each
+    # format.
+    warnings = io.StringIO()
+    old = _set_stderr(_MessageList())
+    try:
+        doc = loads(data)
+        numbering = EqnosFilter(fmts[0], pandocversion)
+        meta, blocks = numbering._start(doc)  # pylint: disable=W0212
+        if not numbering.api_doc:
+            _set_stderr(old)
+            return [filter_captured(data, fmt, numbering.pandocversion)
+                    for fmt in fmts]
+        flags = scan(blocks)
+        _set_stderr(warnings)
+        numbering._number(blocks, meta, flags)  # pylint: disable=W0212
+        flagged = [i for i, block in enumerate(blocks) if id(block) in flags]
+        shared = (dumps(meta), dumps([blocks[i] for i in flagged]))
+    except Exception:  # pylint: disable=broad-except
+        error = traceback.format_exc()
+        return [(None, error, warnings.getvalue()) for _ in fmts]
+    finally:
+        _set_stderr(old)
+
+    results = []
+    for fmt in fmts:
+        stderr = io.StringIO()
+        old = _set_stderr(stderr)
+        # pylint: disable=protected-access
+        try:
+            copies = loads(shared[1])
+            out = dict(doc, meta=loads(shared[0]), blocks=list(blocks))
+            for i, block in zip(flagged, copies):
+                out['blocks'][i] = block
+            eqnos = EqnosFilter(fmt, numbering.pandocversion)
+            meta, altered = eqnos._start(out)
+            STDERR.write(warnings.getvalue())
+            eqnos.unreferenceable = list(numbering.unreferenceable)
+            sites = []
+            flags = scan(copies, sites)
+            altered = eqnos._render(altered, meta, numbering.numbered, flags)
+            out['blocks'] = eqnos._second_pass(altered, meta, flags, sites)
+            eqnos.add_headers(meta)
+            if eqnos.manifestpath or eqnos.depfilepath:
+                eqnos.write_manifest()
+            results.append((dumps(out), None, stderr.getvalue()))
+        except Exception:  # pylint: disable=broad-except
+            results.append((None, traceback.format_exc(), stderr.getvalue()))
+        finally:
+            _set_stderr(old)
+    return results
+
+
+def multi(argv=None):
+    """Filters a json document for several output formats.  Returns the
+    number of formats that failed."""
+
+    import argparse  # pylint: disable=import-outside-toplevel
+
+    parser = argparse.ArgumentParser(
+        prog='pandoc-eqnos multi',
+        description='Filters a pandoc json file for several output formats, '
+        'numbering the equations once.')
+    parser.add_argument('file', help='Json file to filter.')
+    parser.add_argument('-t', '--to', action='append', required=True,
+                        metavar='FMT',
+                        help='Output format (may be repeated).')
+    parser.add_argument('-o', '--output-dir', required=True,
+                        help='Directory for the filtered json.')
+    parser.add_argument('--pandocversion', help='The pandoc version.')
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+    with open(args.file, 'rb') as f:
+        data = f.read()
+    name = os.path.splitext(os.path.basename(args.file))[0]
+
+    failures = 0
+    for fmt, (out, error, stderr) in \
+      zip(args.to, filter_formats(data, args.to, args.pandocversion)):
+        path = os.path.join(args.output_dir, '%s.%s.json' % (name, fmt))
+        STDERR.write(stderr)
+        if error:
+            failures += 1
+            STDERR.write('pandoc-eqnos: %s: failed\n%s' % (path, error))
+        else:
+            with open(path, 'wb') as f:
+                f.write(out)
+        STDERR.flush()
+    return failures
 
-    if 'xnos-number-offset' in meta:
-        secoffset = int(get_meta(meta, 'xnos-number-offset'))
-
-    if 'eqnos-eqref' in meta:
-        eqref = check_bool(get_meta(meta, 'eqnos-eqref'))
-        # Note: Eqref and cleveref are mutually exclusive.  If both are
-        # enabled, then cleveref will be used but with bracketed equation
-        # numbers.
-
-    if 'eqnos-default-env' in meta:
-        default_env = get_meta(meta, 'eqnos-default-env')
-
-def add_tex(meta):
-    """Adds tex to the meta data."""
-
-    warnings = warninglevel == 2 and targets and \
-      (pandocxnos.cleveref_required() or
-       plusname_changed or starname_changed or numbersections or secoffset)
-    if warnings:
-        msg = textwrap.dedent("""\
-                  pandoc-eqnos: Wrote the following blocks to
-                  header-includes.  If you use pandoc's
-                  --include-in-header option then you will need to
-                  manually include these yourself.
-              """)
-        STDERR.write('\n')
-        STDERR.write(textwrap.fill(msg))
-        STDERR.write('\n')
-
-    # Update the header-includes metadata.  Pandoc's
-    # --include-in-header option will override anything we do here.  This
-    # is a known issue and is owing to a design decision in pandoc.
-    # See https://github.com/jgm/pandoc/issues/3139.
-
-    if pandocxnos.cleveref_required() and targets:
-        tex = """
-            %%%% pandoc-eqnos: required package
-            \\usepackage%s{cleveref}
-        """ % ('[capitalise]' if capitalise else '')
-        pandocxnos.add_to_header_includes(
-            meta, 'tex', tex,
-            regex=r'\\usepackage(\[[\w\s,]*\])?\{cleveref\}')
-
-        if not eqref:
-            pandocxnos.add_to_header_includes(
-                meta, 'tex', DISABLE_CLEVEREF_BRACKETS_TEX)
-
-    if plusname_changed and targets:
-        tex = """
-            %%%% pandoc-eqnos: change cref names
-            \\crefname{equation}{%s}{%s}
-        """ % (plusname[0], plusname[1])
-        pandocxnos.add_to_header_includes(meta, 'tex', tex)
-
-    if starname_changed and targets:
-        tex = """
-            %%%% pandoc-eqnos: change Cref names
-            \\Crefname{equation}{%s}{%s}
-        """ % (starname[0], starname[1])
-        pandocxnos.add_to_header_includes(meta, 'tex', tex)
-
-    if numbersections and targets:
-        pandocxnos.add_to_header_includes(meta, 'tex', NUMBER_BY_SECTION_TEX)
-
-    if secoffset and targets:
-        pandocxnos.add_to_header_includes(
-            meta, 'tex', SECOFFSET_TEX % secoffset,
-            regex=r'\\setcounter\{section\}')
-
-    if warnings:
-        STDERR.write('\n')
-
-def add_html(meta, fmt):
-    """Adds html to the meta data."""
-
-    warnings = warninglevel == 2 and targets
-
-    if warnings:
-        msg = textwrap.dedent("""\
-                  pandoc-eqnos: Wrote the following blocks to
-                  header-includes.  If you use pandoc's
-                  --include-in-header option then you will need to
-                  manually include these yourself.
-              """)
-        STDERR.write('\n')
-        STDERR.write(textwrap.fill(msg))
-        STDERR.write('\n')
-
-    # Update the header-includes metadata.  Pandoc's
-    # --include-in-header option will override anything we do here.  This
-    # is a known issue and is owing to a design decision in pandoc.
-    # See https://github.com/jgm/pandoc/issues/3139.
-
-    if targets:
-        cond = fmt == 'html4' or \
-          (fmt == 'html' and version(PANDOCVERSION) < version('2.0'))
-        attr = ' type="text/css"' if cond else ''
-        pandocxnos.add_to_header_includes(meta, 'html',
-                                          EQUATION_STYLE_HTML%attr)
 
-# pylint: disable=too-many-locals, unused-argument
-def main(stdin=STDIN, stdout=STDOUT, stderr=STDERR):
-    """Filters the document AST."""
+# Build driver ---------------------------------------------------------------
 
-    # pylint: disable=global-statement
-    global PANDOCVERSION
-    global AttrMath
+# `pandoc-eqnos build -t FMT [-t FMT ...] -o DIR SOURCE ...` converts many
+# source documents with pandoc, filtering them in this process rather than in
+# a filter process started by pandoc for each document and format.  For each
+# source, `pandoc SOURCE -t json` is run once; its output is filtered for all
+# of the formats by filter_formats(), and each result is passed to
+# `pandoc -f json -t FMT` to be written to DIR/NAME.EXT.  Options after `--`
+# are passed to the writing pandoc.
+#
+# The pandoc processes are run as asyncio subprocesses, at most --jobs at a
+# time.  The filtering is done in the event loop's thread, one document at a
+# time, as pandocxnos keeps module-level state.  Callbacks are used rather
+# than coroutine syntax so that this module can still be compiled by Python 2.
+
+# Output file extensions for formats that aren't named after them
+BUILD_EXTENSIONS = {'latex': 'tex', 'beamer': 'tex', 'context': 'tex',
+                    'html4': 'html', 'html5': 'html', 'epub2': 'epub',
+                    'epub3': 'epub', 'markdown': 'md', 'gfm': 'md',
+                    'commonmark': 'md', 'plain': 'txt', 'native': 'hs'}
+
+
+class _PandocRunner(object):
+    """Runs pandoc processes in an asyncio event loop, at most `jobs` at a
+    time."""
+
+    def __init__(self, loop, pandoc, jobs):
+        import collections  # pylint: disable=import-outside-toplevel
+        self.loop = loop
+        self.pandoc = pandoc
+        self.jobs = jobs
+        self.queue = collections.deque()  # Runs waiting for a slot
+        self.running = 0
+        self.done = loop.create_future()  # Set when nothing is left to run
+
+    def run(self, args, data, callback):
+        """Runs pandoc with the command-line `args`, passing it the bytes
+        `data` on stdin.  Calls `callback(out, error)` when it finishes, where
+        `out` is pandoc's stdout and `error` is None or the error message."""
+        self.queue.append((args, data, callback))
+        self._next()
+
+    def _next(self):
+        """Starts the waiting runs that there are slots for."""
+        import asyncio  # pylint: disable=import-outside-toplevel
+        import functools  # pylint: disable=import-outside-toplevel
+        while self.running < self.jobs and self.queue:
+            args, data, callback = self.queue.popleft()
+            self.running += 1
+            task = self.loop.create_task(asyncio.create_subprocess_exec(
+                self.pandoc, *args, stdin=asyncio.subprocess.DEVNULL
+                if data is None else asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE))
+            task.add_done_callback(functools.partial(self._started, data,
+                                                     callback))
+        if not self.running and not self.done.done():
+            self.done.set_result(None)
+
+    def _started(self, data, callback, task):
+        """Feeds `data` to the process started by `task`."""
+        try:
+            proc = task.result()
+        except (IOError, OSError) as e:
+            self._finished(callback, None, 'Could not run %s: %s' % \
+                           (self.pandoc, e))
+            return
+        def communicated(task):
+            """Passes on the process's results."""
+            out, err = task.result()
+            error = None
+            if proc.returncode:
+                error = err.decode('utf-8', 'replace').strip() or \
+                  '%s exited with status %d' % (self.pandoc, proc.returncode)
+            self._finished(callback, out, error)
+        self.loop.create_task(proc.communicate(data))\
+          .add_done_callback(communicated)
+
+    def _finished(self, callback, out, error):
+        """Hands the results of a run to its `callback` and frees its
+        slot."""
+        self.running -= 1
+        try:
+            callback(out, error)
+        finally:
+            self._next()
+
+
+# pylint: disable=too-many-locals
+def build(argv=None):
+    """Converts many documents with pandoc, filtering them in this process.
+    Returns the number of outputs that failed."""
+
+    # pylint: disable=import-outside-toplevel
+    import argparse
+    import asyncio
+    import functools
+
+    argv = list(sys.argv[2:] if argv is None else argv)
+    extra = argv[argv.index('--')+1:] if '--' in argv else []
+    argv = argv[:argv.index('--')] if '--' in argv else argv
+
+    parser = argparse.ArgumentParser(
+        prog='pandoc-eqnos build',
+        description='Converts many documents with pandoc, filtering them '
+        'in this process.  Options after -- are passed to pandoc when '
+        'writing.')
+    parser.add_argument('sources', nargs='+', help='Source documents.')
+    parser.add_argument('-t', '--to', action='append', required=True,
+                        metavar='FMT',
+                        help='Output format (may be repeated).')
+    parser.add_argument('-f', '--from', dest='reader', metavar='FMT',
+                        help='Input format.')
+    parser.add_argument('-o', '--output-dir', required=True,
+                        help='Directory for the outputs.')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='Number of pandoc processes to run at a time '
+                        '(default: one per cpu).')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='Only report outputs that have problems.')
+    parser.add_argument('--pandoc', default='pandoc',
+                        help='The pandoc executable (default: pandoc).')
+    parser.add_argument('--pandocversion', help='The pandoc version.')
+    args = getattr(parser, 'parse_intermixed_args', parser.parse_args)(argv)
+
+    names = [os.path.splitext(os.path.basename(path))[0]
+             for path in args.sources]
+    if len(set(names)) < len(names):
+        parser.error('source names (file names without extensions) must be '
+                     'unique')
+    if not os.path.isdir(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    loop = asyncio.new_event_loop()
+    runner = _PandocRunner(loop, args.pandoc,
+                           args.jobs or os.cpu_count() or 1)
+    state = {'version': args.pandocversion, 'written': 0, 'failures': 0}
+
+    def report(name, error, stderr=''):
+        """Reports the outcome for the output `name`."""
+        state['failures' if error else 'written'] += 1
+        if error or stderr or not args.quiet:
+            STDERR.write('pandoc-eqnos: %s: %s\n' % \
+                         (name, 'failed' if error else 'ok'))
+            STDERR.write(stderr)
+            if error:
+                STDERR.write(error.rstrip('\n') + '\n')
+            STDERR.flush()
+
+    def convert(source, name):
+        """Reads `source` to json, and filters and writes it for each
+        format."""
+        def read(out, error):
+            """Filters the json `out` and writes it for each format."""
+            results = [(None, error, '')] * len(args.to) if error else \
+              filter_formats(out, args.to, state['version'])
+            for fmt, (data, failure, stderr) in zip(args.to, results):
+                path = os.path.join(args.output_dir, name + '.' +
+                                    BUILD_EXTENSIONS.get(fmt, fmt))
+                if failure:
+                    report(path, failure, stderr)
+                    continue
+                runner.run(['-f', 'json', '-t', fmt, '-o', path] + extra,
+                           data, functools.partial(wrote, path, stderr))
+        runner.run([source, '-t', 'json'] +
+                   (['-f', args.reader] if args.reader else []), None, read)
+
+    def wrote(path, stderr, _, error):
+        """Reports the outcome of writing `path`."""
+        report(path, error, stderr)
+
+    def start(out, error):
+        """Starts the conversions once the pandoc version is known."""
+        if error:
+            STDERR.write('pandoc-eqnos: %s\n' % error)
+            STDERR.flush()
+            state['failures'] += 1
+            return
+        state['version'] = state['version'] or _pandoc_version(out)
+        for source, name in zip(args.sources, names):
+            convert(source, name)
+
+    try:
+        if args.pandocversion:
+            start(None, None)
+        else:
+            runner.run(['--version'], None, start)
+        loop.run_until_complete(runner.done)
+    finally:
+        loop.close()
+
+    STDERR.write('pandoc-eqnos: Wrote %d outputs; %d failed.\n' % \
+                 (state['written'], state['failures']))
+    STDERR.flush()
+    return state['failures']
+
+
+# Main program ---------------------------------------------------------------
+
+def is_passthrough(data):
+    """Returns True if the json bytes `data` cannot contain anything for
+    this filter to do; i.e., there are no equation labels or references, no
+    strings that could be attributes, and no label manifest or depfile to
+    write.  This is a conservative test on the raw json, made before it is
+    parsed."""
+    return b'eq:' not in data and not ATTRS_PATTERN.search(data) and \
+      b'eqnos-manifest' not in data and b'eqnos-depfile' not in data
+
+
+def filter_bytes(data, fmt, pandocversion=None, profile=None):
+    """Filters the json document `data` (bytes) for the output format
+    `fmt`.  Timings and counts are collected in `profile`, if it is given.
+    Returns the filtered json as bytes."""
+
+    # Pass the document straight through if there is nothing to do.  This
+    # is silent, as filtering such a document would be.
+    if is_passthrough(data):
+        if profile:
+            profile.count('passthrough', 1)
+        return data
+
+    # Return the stored results if the document was filtered before;
+    # otherwise keep a copy of the warnings to be stored with the results.
+    # Documents that use a label index aren't cached because their results
+    # also depend on the index, and documents that write a label manifest or
+    # depfile aren't cached so that these are always written.
+    cachedir = os.environ.get('PANDOC_EQNOS_CACHE') \
+      if b'eqnos-index' not in data and b'eqnos-manifest' not in data and \
+      b'eqnos-depfile' not in data else None
+    if cachedir:
+        key = cache_key(data, fmt, pandocversion)
+        entry = cache_get(cachedir, key)
+        if entry:
+            STDERR.write(entry[1])
+            STDERR.flush()
+            if profile:
+                profile.count('cache-hits', 1)
+            return entry[0]
+        stderr = _TeeStream(STDERR)
+        old = _set_stderr(stderr)
+
+    # Filter a very large document in parallel, if requested.  Documents
+    # that use a label index, a state file, or write a label manifest or
+    # depfile are filtered serially.
+    jobs = int(os.environ.get('PANDOC_EQNOS_JOBS') or 0)
+    parallel = jobs > 1 and b'eqnos-index' not in data and \
+      b'eqnos-state' not in data and b'eqnos-manifest' not in data and \
+      b'eqnos-depfile' not in data and \
+      len(data) >= int(os.environ.get('PANDOC_EQNOS_PARALLEL_SIZE',
+                                      PARALLEL_SIZE))
+
+    loads, dumps = get_codec()
+    doc = profile.timed('loads', loads, data) if profile else loads(data)
+    del data  # Don't hold both the json and the document in memory
+
+    # Filter the document
+    try:
+        if parallel:
+            data = filter_parallel(doc, fmt, pandocversion, jobs, profile)
+        else:
+            eqnos = EqnosFilter(fmt, pandocversion, profile)
+            doc = profile.timed('filter', eqnos.run, doc) if profile \
+              else eqnos.run(doc)
+    finally:
+        if cachedir:
+            _set_stderr(old)
+    if not parallel:
+        data = profile.timed('dumps', dumps, doc) if profile else dumps(doc)
+
+    if cachedir:
+        cache_put(cachedir, key, data, stderr.getvalue())
+
+    return data
+
+
+# Subcommands; these take the remaining command-line arguments and return a
+# value that is true on failure
+SUBCOMMANDS = {'batch': batch, 'build': build, 'index': index,
+               'multi': multi, 'stream': stream}
+
+def _parse_args(argv):
+    """Parses the command-line arguments `argv`.  Returns the output format,
+    pandoc version, server socket path and profiling flag.
+
+    Pandoc calls filters with the output format as the lone argument.  This
+    common case is handled without importing argparse."""
+
+    if len(argv) == 1 and not argv[0].startswith('-'):
+        return argv[0], None, None, False
+
+    import argparse  # pylint: disable=import-outside-toplevel
 
-    # Read the command-line arguments
     parser = argparse.ArgumentParser(\
       description='Pandoc equations numbers filter.')
     parser.add_argument(\
       '--version', action='version',
       version='%(prog)s {version}'.format(version=__version__))
-    parser.add_argument('fmt')
+    parser.add_argument('fmt', nargs='?')
     parser.add_argument('--pandocversion', help='The pandoc version.')
-    args = parser.parse_args()
+    parser.add_argument('--serve', metavar='SOCKET',
+                        help='Serve filter requests on a unix socket.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Report timings and counts to stderr as json.')
+    args = parser.parse_args(argv)
 
-    # Get the output format and document
-    fmt = args.fmt
-    doc = json.loads(stdin.read())
+    if not args.fmt and not args.serve:
+        parser.error('the following arguments are required: fmt')
 
-    # Initialize pandocxnos
-    PANDOCVERSION = pandocxnos.init(args.pandocversion, doc)
+    return args.fmt, args.pandocversion, args.serve, args.profile
 
-    # Element primitives
-    AttrMath = elt('Math', 3)
 
-    # Chop up the doc
-    meta = doc['meta'] if version(PANDOCVERSION) >= version('1.18') \
-      else doc[0]['unMeta']
-    blocks = doc['blocks'] if version(PANDOCVERSION) >= version('1.18') \
-      else doc[1:]
-
-    # Process the metadata variables
-    process(meta)
-
-    # First pass
-    attach_attrs_math = attach_attrs_factory(Math, allow_space=True)
-    detach_attrs_math = detach_attrs_factory(Math)
-    insert_secnos = insert_secnos_factory(Math)
-    delete_secnos = delete_secnos_factory(Math)
-    altered = functools.reduce(lambda x, action: walk(x, action, fmt, meta),
-                               [attach_attrs_math, insert_secnos,
-                                process_equations, delete_secnos,
-                                detach_attrs_math], blocks)
-
-    # Second pass
-    process_refs = process_refs_factory(LABEL_PATTERN, targets.keys())
-    replace_refs = replace_refs_factory(targets,
-                                        cleveref, eqref,
-                                        plusname if not capitalise or \
-                                        plusname_changed else
-                                        [name.title() for name in plusname],
-                                        starname)
-    attach_attrs_span = attach_attrs_factory(Span, replace=True)
-    altered = functools.reduce(lambda x, action: walk(x, action, fmt, meta),
-                               [repair_refs, process_refs, replace_refs,
-                                attach_attrs_span],
-                               altered)
-
-    if fmt in ['latex', 'beamer']:
-        add_tex(meta)
-    elif fmt in ['html', 'html4', 'html5', 'epub', 'epub2', 'epub3']:
-        add_html(meta, fmt)
-
-    # Update the doc
-    if version(PANDOCVERSION) >= version('1.18'):
-        doc['blocks'] = altered
-    else:
-        doc = doc[:1] + altered
+# pylint: disable=too-many-locals, unused-argument
+def main(stdin=STDIN, stdout=STDOUT, stderr=STDERR):
+    """Filters the document AST."""
+
+    # Dispatch subcommands
+    if sys.argv[1:] and sys.argv[1] in SUBCOMMANDS:
+        raise SystemExit(1 if SUBCOMMANDS[sys.argv[1]](sys.argv[2:]) else 0)
 
-    # Dump the results
-    json.dump(doc, stdout)
+    # Read the command-line arguments
+    fmt, pandocversion, sockpath, profiling = _parse_args(sys.argv[1:])
+
+    if sockpath:
+        serve(sockpath)
+        return
+
+    # Collect timings and counts, if requested
+    profile = Profile() \
+      if profiling or os.environ.get('PANDOC_EQNOS_PROFILE') else None
+    def timed(name, func, *args):
+        """Calls `func(*args)`, timing it if profiling."""
+        return profile.timed(name, func, *args) if profile else func(*args)
+
+    # Forward the document to a server, if there is one
+    path = os.environ.get('PANDOC_EQNOS_SOCKET')
+    if path:
+        data = timed('read', read_bytes, stdin)
+        try:
+            # The server doesn't share our environment, so send the version
+            reply, altered = timed(
+                'request', request, path, data, fmt,
+                pandocversion or os.environ.get('PANDOC_VERSION'))
+        except (IOError, OSError, ValueError):
+            # No server, or no usable reply; filter locally instead
+            altered = filter_bytes(data, fmt, pandocversion, profile)
+        else:
+            STDERR.write(reply['stderr'])
+            if reply['status'] != 'ok':
+                STDERR.write(reply['message'])
+                STDERR.flush()
+                raise SystemExit(1)
+            STDERR.flush()
+        timed('write', write_bytes, stdout, altered)
+
+    # Filter the document and write the results
+    else:
+        timed('write', write_bytes, stdout,
+              filter_bytes(timed('read', read_bytes, stdin), fmt,
+                           pandocversion, profile))
 
-    # Flush stdout
-    stdout.flush()
+    if profile:
+        profile.write(STDERR)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,323 @@
+#! /usr/bin/env python3
+
+"""bench.py: benchmarks for pandoc-eqnos.
+
+Usage: python3 bench.py [--save FILE] [--compare FILE] [--case NAME ...]
+
+The benchmark documents are pandoc json ASTs made by a synthetic
+generator, so no pandoc executable is needed.  For each case, main() is
+timed end to end and each of its stages (json parsing, scanning, the two
+filter passes and json output) is timed separately.  The best of several
+repeats is reported.  The peak memory taken by main() is measured using
+tracemalloc.
+
+Results may be saved as a baseline (--save) and later runs compared against
+it (--compare).  A case that is slower or larger than the baseline by more
+than the tolerance (default 15%) is reported as a regression, and the
+script exits with a nonzero status.
+"""
+
+# pylint: disable=invalid-name
+
+import argparse
+import copy
+import io
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import pandoc_eqnos  # pylint: disable=wrong-import-position
+
+
+# Generator ------------------------------------------------------------------
+
+API_VERSION = [1, 22]  # pandoc 2.11
+PANDOC_VERSION = '2.11'
+
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet,', 'consectetur', 'elit.']
+
+SPACE = {'t': 'Space'}
+
+def Str(text):
+    """Returns a Str element."""
+    return {'t': 'Str', 'c': text}
+
+def Para(inlines):
+    """Returns a Para element."""
+    return {'t': 'Para', 'c': inlines}
+
+def Header(level, text, unnumbered=False):
+    """Returns a Header element."""
+    classes = ['unnumbered'] if unnumbered else []
+    return {'t': 'Header',
+            'c': [level, [text.lower(), classes, []], [Str(text)]]}
+
+def Math(text, display=True):
+    """Returns a Math element."""
+    mathtype = 'DisplayMath' if display else 'InlineMath'
+    return {'t': 'Math', 'c': [{'t': mathtype}, text]}
+
+def Cite(label, mode='AuthorInText', prefix=None):
+    """Returns a Cite element for a reference to `label`."""
+    text = '@' + label if mode == 'AuthorInText' else '[@%s]' % label
+    return {'t': 'Cite',
+            'c': [[{'citationId': label, 'citationPrefix': prefix or [],
+                    'citationSuffix': [], 'citationMode': {'t': mode},
+                    'citationNoteNum': 1, 'citationHash': 0}],
+                  [Str(text)]]}
+
+
+def _words(rng, n):
+    """Returns `n` inline words separated by spaces."""
+    inlines = []
+    for i in range(n):
+        if i:
+            inlines.append(SPACE)
+        inlines.append(Str(rng.choice(WORDS)))
+    return inlines
+
+
+def _nest(block, depth):
+    """Nests `block` in alternating block quotes and lists."""
+    for i in range(depth - 1):
+        block = {'t': 'BlockQuote', 'c': [block]} if i % 2 == 0 \
+          else {'t': 'BulletList', 'c': [[block]]}
+    return block
+
+
+# Forms of references and their weights
+REFS = [(lambda label: [Cite(label)], 4),
+        (lambda label: [Str('+'), Cite(label)], 2),
+        (lambda label: [Str('*'), Cite(label)], 1),
+        (lambda label: [Str('{'), Cite(label), Str('}')], 1),
+        (lambda label: [Cite(label, 'NormalCitation')], 2),
+        (lambda label: [Cite(label, 'NormalCitation', [Str('+')])], 1),
+        (lambda label: [Str('!'), Cite(label)], 1)]
+
+# pylint: disable=too-many-arguments, too-many-locals
+def generate(equations=100, references=200, sections=10, tagged=0.1,
+             depth=1, prose=4, meta=None, seed=0):
+    """Returns a pandoc document with the given numbers of `equations`,
+    `references` and `sections`.  `tagged` is the fraction of equations
+    with tags, `depth` is the nesting depth of the equations' paragraphs and
+    `prose` is the number of plain paragraphs per equation."""
+
+    rng = random.Random(seed)
+    forms = [form for form, weight in REFS for _ in range(weight)]
+    blocks = []
+    labels = []
+    per = max(1, equations // max(sections, 1))  # Equations per section
+    for n in range(equations):
+        if n % per == 0 and n // per < sections:
+            blocks.append(Header(1, 'Section %d' % (n // per + 1)))
+        for _ in range(prose):
+            blocks.append(Para(_words(rng, 40)))
+        label = 'eq:%d' % n
+        attrs = '{#%s}' % label if rng.random() >= tagged else \
+          '{#%s tag="A.%d"}' % (label, n)
+        blocks.append(_nest(Para(_words(rng, 5) + [SPACE, Math('x_{%d}' % n),
+                                                  SPACE, Str(attrs)]),
+                            depth))
+        labels.append(label)
+
+    for _ in range(references):
+        label = rng.choice(labels) if labels else 'eq:missing'
+        inlines = _words(rng, 6) + [SPACE] + rng.choice(forms)(label) + \
+          [Str('.')]
+        blocks.insert(rng.randrange(len(blocks) + 1), Para(inlines))
+
+    return {'pandoc-api-version': API_VERSION, 'meta': meta or {},
+            'blocks': blocks}
+
+
+def MetaBool(value):
+    """Returns a MetaBool meta value."""
+    return {'t': 'MetaBool', 'c': value}
+
+
+# Cases ----------------------------------------------------------------------
+
+SIZES = {
+    'small': dict(equations=20, references=40, sections=4),
+    'medium': dict(equations=500, references=1000, sections=20),
+    'large': dict(equations=2000, references=4000, sections=50),
+}
+
+VARIANTS = {
+    'flat': dict(),
+    'deep': dict(depth=6),
+    'tagged': dict(tagged=0.5),
+    'bysec': dict(meta={'eqnos-number-by-section': MetaBool(True)}),
+    'prose': dict(equations=20, references=20, prose=100),
+}
+
+FORMATS = ['latex', 'html', 'docx', 'plain']
+
+def cases():
+    """Returns a dict of case names to (fmt, document kwargs)."""
+    ret = {}
+    for size, sizekw in SIZES.items():
+        for variant, variantkw in VARIANTS.items():
+            if variant != 'flat' and size != 'medium':
+                continue
+            for fmt in FORMATS:
+                kwargs = dict(sizekw, **variantkw)
+                ret['%s-%s-%s' % (size, variant, fmt)] = (fmt, kwargs)
+    return ret
+
+
+# Measurements ---------------------------------------------------------------
+
+def run_main(data, fmt):
+    """Runs main() on the json `data` for the output format `fmt`.  Returns
+    the output."""
+    stdin, stdout = io.BytesIO(data), io.BytesIO()
+    argv = sys.argv
+    sys.argv = ['pandoc-eqnos', fmt, '--pandocversion', PANDOC_VERSION]
+    try:
+        pandoc_eqnos.main(stdin, stdout)
+    finally:
+        sys.argv = argv
+    return stdout.getvalue()
+
+
+def run_stages(data, fmt):
+    """Runs the stages of main() on the json `data` for the output format
+    `fmt`.  Returns a dict of stage names to times."""
+    times = {}
+    loads, dumps = pandoc_eqnos.get_codec()
+
+    t0 = time.perf_counter()
+    doc = loads(data)
+    t1 = time.perf_counter()
+    times['parse'] = t1 - t0
+
+    # Follow the steps taken by EqnosFilter.run()
+    eqnos = pandoc_eqnos.EqnosFilter(fmt, PANDOC_VERSION)
+    meta, blocks = eqnos._start(doc)  # pylint: disable=protected-access
+    sites = []
+    flags = pandoc_eqnos.scan(blocks, sites)
+    t2 = time.perf_counter()
+    times['scan'] = t2 - t1
+
+    # pylint: disable=protected-access
+    altered = eqnos._first_pass(blocks, meta, flags)
+    t3 = time.perf_counter()
+    times['first'] = t3 - t2
+
+    doc['blocks'] = eqnos._second_pass(altered, meta, flags, sites)
+    t4 = time.perf_counter()
+    times['second'] = t4 - t3
+
+    dumps(doc)
+    times['dump'] = time.perf_counter() - t4
+
+    return times
+
+
+def measure(fmt, data, repeat):
+    """Measures the filter on the json `data`.  Returns a dict of results;
+    times are the best of `repeat` runs in ms and memory is in MB."""
+    results = {}
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        run_main(data, fmt)
+        elapsed = time.perf_counter() - t0
+        results['main'] = min(results.get('main', elapsed), elapsed)
+        for stage, elapsed in run_stages(data, fmt).items():
+            results[stage] = min(results.get(stage, elapsed), elapsed)
+    results = dict((key, round(value*1000, 2))
+                   for key, value in results.items())
+
+    tracemalloc.start()
+    run_main(data, fmt)
+    results['peak'] = round(tracemalloc.get_traced_memory()[1] / 2.**20, 2)
+    tracemalloc.stop()
+
+    results['size'] = round(len(data) / 2.**20, 2)
+    return results
+
+
+# Main program ---------------------------------------------------------------
+
+COLUMNS = ['main', 'parse', 'scan', 'first', 'second', 'dump', 'peak', 'size']
+
+# Differences that are too small to be told apart from noise
+MINIMUM = {'main': 2., 'peak': 0.5}
+
+def compare(results, baseline, tolerance):
+    """Compares `results` with the `baseline`.  Returns a list of
+    regressions."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for key in ['main', 'peak']:
+            old, new = baseline[name][key], result[key]
+            if new > old * (1 + tolerance) and new - old > MINIMUM[key]:
+                regressions.append('%s: %s %.2f -> %.2f (%+.0f%%)' % \
+                                   (name, key, old, new, (new/old-1)*100))
+    return regressions
+
+
+def main():
+    """Runs the benchmarks."""
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--case', action='append',
+                        help='Run only the named cases (may be repeated; '
+                        'a prefix selects all matching cases).')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of timed runs per case (default: 5).')
+    parser.add_argument('--save', metavar='FILE',
+                        help='Save the results as a baseline.')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='Compare the results with a baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='Allowed fractional slowdown or growth '
+                        '(default: 0.15).')
+    args = parser.parse_args()
+
+    # Keep the filter's warnings out of the report
+    pandoc_eqnos._set_stderr(io.StringIO())  # pylint: disable=protected-access
+
+    selected = sorted(name for name in cases() if not args.case or
+                      any(name.startswith(case) for case in args.case))
+
+    sys.stdout.write('%-26s' % 'case (ms, MB)' +
+                     ''.join('%9s' % column for column in COLUMNS) + '\n')
+    results = {}
+    for name in selected:
+        fmt, kwargs = cases()[name]
+        data = json.dumps(generate(**copy.deepcopy(kwargs))).encode('utf-8')
+        results[name] = measure(fmt, data, args.repeat)
+        sys.stdout.write('%-26s' % name +
+                         ''.join('%9.2f' % results[name][column]
+                                 for column in COLUMNS) + '\n')
+        sys.stdout.flush()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': sys.version.split()[0],
+                       'version': pandoc_eqnos.__version__,
+                       'results': results}, f, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            sys.stdout.write('Regression: %s\n' % regression)
+        if regressions:
+            sys.exit(1)
+        sys.stdout.write('No regressions against %s.\n' % args.compare)
+
+
+if __name__ == '__main__':
+    main()
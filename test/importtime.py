@@ -0,0 +1,69 @@
+#! /usr/bin/env python3
+
+"""importtime.py: check the import-time budget for pandoc-eqnos.
+
+Usage: python3 importtime.py [budget-in-ms]
+
+The filter is started once per document by pandoc, so its import time is
+paid on every run.  This script imports the module in a fresh interpreter
+using `-X importtime`, fails if the cumulative time exceeds the budget
+(default 30 ms, or $IMPORTTIME_BUDGET), and fails if any of the heavy
+dependencies that are only needed once a document is actually filtered
+get imported eagerly.
+"""
+
+import os
+import subprocess
+import sys
+
+# Modules that must not be imported by `import pandoc_eqnos`
+LAZY = ['pandocxnos', 'pandocfilters', 'psutil', 'argparse', 'json', 'uuid',
+        'textwrap', 'socket', 'socketserver', 'multiprocessing']
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def measure():
+    """Returns a dict of module names to cumulative import times in us."""
+    env = dict(os.environ)
+    paths = [os.path.dirname(HERE), env.get('PYTHONPATH', '')]
+    env['PYTHONPATH'] = os.pathsep.join(path for path in paths if path)
+    # Time the import from bytecode, as for an installed copy
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    subprocess.check_call([sys.executable, '-c', 'import pandoc_eqnos'],
+                          env=env)
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c',
+                             'import pandoc_eqnos'],
+                            stderr=subprocess.PIPE, env=env)
+    _, err = proc.communicate()
+    if proc.returncode:
+        sys.stderr.write(err.decode())
+        sys.exit(1)
+    times = {}
+    for line in err.decode().splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        fields = [field.strip() for field in line[12:].split('|')]
+        if fields[1].isdigit():
+            times[fields[2]] = int(fields[1])
+    return times
+
+
+def main():
+    """Main program."""
+    budget = float(sys.argv[1] if len(sys.argv) > 1 else \
+                   os.environ.get('IMPORTTIME_BUDGET', 30))
+    times = measure()
+    elapsed = times['pandoc_eqnos']/1000.
+    eager = [name for name in LAZY if name in times]
+
+    sys.stdout.write('pandoc_eqnos imported in %.1f ms (budget %.1f ms)\n' % \
+                     (elapsed, budget))
+    if eager:
+        sys.stdout.write('Eagerly imported: %s\n' % ', '.join(eager))
+    if elapsed > budget or eager:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
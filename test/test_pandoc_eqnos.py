@@ -0,0 +1,726 @@
+#! /usr/bin/env python3
+
+"""test_pandoc_eqnos.py: behaviour tests for pandoc-eqnos.
+
+Usage: python3 -m pytest test  (or: python3 -m unittest discover test)
+
+The test documents are pandoc json ASTs, either made by hand or by the
+generator in bench.py, and so no pandoc executable is needed.  The filter's
+modes (server, batch, cache, index, parallel, stream, incremental, multi,
+build, manifest and chaining) are checked against the output of the plain
+serial filter.
+"""
+
+# pylint: disable=invalid-name, missing-docstring, protected-access
+
+import contextlib
+import copy
+import io
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+# pylint: disable=wrong-import-position
+import pandoc_eqnos
+from bench import generate, Cite, Math, MetaBool, Para, Str, SPACE
+
+
+PANDOC_VERSION = '2.11'
+
+
+# Helpers --------------------------------------------------------------------
+
+@contextlib.contextmanager
+def environment(env):
+    """Sets the environment variables in the dict `env` for the duration of
+    the context."""
+    saved = dict((name, os.environ.get(name)) for name in env or {})
+    os.environ.update(env or {})
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+def run_filter(doc, fmt='html', pandocversion=PANDOC_VERSION, env=None):
+    """Runs the filter on `doc` as pandoc would, with the environment
+    variables `env` set.  Returns the output document and the warnings."""
+    stdin = io.BytesIO(json.dumps(doc).encode('utf-8'))
+    stdout = io.BytesIO()
+    stderr = io.StringIO()
+    argv = sys.argv
+    sys.argv = ['pandoc-eqnos', fmt, '--pandocversion', pandocversion]
+    old = pandoc_eqnos._set_stderr(stderr)
+    try:
+        with environment(env):
+            pandoc_eqnos.main(stdin, stdout)
+    finally:
+        sys.argv = argv
+        pandoc_eqnos._set_stderr(old)
+    return json.loads(stdout.getvalue().decode('utf-8')), stderr.getvalue()
+
+
+def MetaString(text):
+    """Returns a MetaString meta value."""
+    return {'t': 'MetaString', 'c': text}
+
+
+class TempDirTestCase(unittest.TestCase):
+    """A test case with a temporary directory."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        """Returns the path for `name` in the temporary directory."""
+        return os.path.join(self.tmpdir, name)
+
+
+def old_doc(blocks, meta=None):
+    """Returns a document in the form used by pandoc < 1.18."""
+    return [{'unMeta': meta or {}}, blocks]
+
+
+def Link(text, url):
+    """Returns a Link element (pandoc 1.16 and 1.17)."""
+    return {'t': 'Link', 'c': [['', [], []], [Str(text)], [url, '']]}
+
+
+def equation(label, tex='x'):
+    """Returns a paragraph with an equation labelled `label`."""
+    return Para([Math(tex), SPACE, Str('{#%s}' % label)])
+
+
+# Passthrough ----------------------------------------------------------------
+
+class TestPassthrough(unittest.TestCase):
+
+    def test_passthrough(self):
+        doc = {'pandoc-api-version': [1, 22], 'meta': {},
+               'blocks': [Para([Str('No'), SPACE, Str('equations.')])]}
+        for meta in [{}, {'eqnos-warning-level': MetaString('0')}]:
+            doc['meta'] = meta
+            data = json.dumps(doc).encode('utf-8')
+            self.assertTrue(pandoc_eqnos.is_passthrough(data))
+            self.assertEqual(run_filter(doc), (doc, ''))
+
+
+# Target table ---------------------------------------------------------------
+
+class TestTargetTable(unittest.TestCase):
+
+    def setUp(self):
+        pandoc_eqnos._import_deps()
+
+    def test_delete(self):
+        Target = pandoc_eqnos.pandocxnos.Target
+        targets = [Target(1, 0, True), Target('A', 0, False),
+                   Target(3, 2, False), Target(2**40, 0, False)]
+        table = pandoc_eqnos.TargetTable()
+        expected = {}
+        for n in range(200):
+            label = 'eq:%d' % (n % 17)
+            if n % 3 == 2 and label in expected:
+                del table[label]
+                del expected[label]
+            else:
+                table[label] = expected[label] = targets[n % len(targets)]
+            self.assertEqual(dict(table), expected)
+            self.assertEqual(len(table), len(expected))
+            # Deleted labels leave no slots behind
+            self.assertLessEqual(len(table._nums), 17)
+        table.clear()
+        self.assertEqual((len(table), len(table._nums)), (0, 0))
+
+
+# Renderers ------------------------------------------------------------------
+
+def find_elements(x, tag):
+    """Returns the elements of type `tag` in the pandoc json `x`."""
+    if isinstance(x, list):
+        return [element for item in x for element in find_elements(item, tag)]
+    if isinstance(x, dict):
+        found = [x] if x.get('t') == tag else []
+        return found + find_elements(x.get('c'), tag)
+    return []
+
+
+class TestRenderers(unittest.TestCase):
+
+    def test_fresh_elements(self):
+        for fmt in ['html', 'epub', 'docx']:
+            doc = generate(20, 20, tagged=0.2, seed=3)
+            doc = pandoc_eqnos.EqnosFilter(fmt, PANDOC_VERSION).run(doc)
+            raws = find_elements(doc['blocks'], 'RawInline')
+            self.assertGreaterEqual(len(raws), 2*20)
+            # No element is inserted twice
+            self.assertEqual(len(set(id(raw) for raw in raws)), len(raws))
+
+
+# Pandoc < 1.18 --------------------------------------------------------------
+
+def broken_ref_doc(meta=None):
+    """Returns a pandoc < 1.18 document with a broken reference; pandoc
+    splits '{+@eq:a}' into a Link and a Str."""
+    return old_doc([equation('eq:a'),
+                    Para([Str('See'), SPACE, Str('{+'),
+                          Link('@eq', 'mailto:@eq'), Str(':a}.')])], meta)
+
+
+class TestOldPandoc(TempDirTestCase):
+
+    def test_broken_reference(self):
+        out, _ = run_filter(broken_ref_doc(), 'html', '1.17')
+        self.assertEqual(out[1][1]['c'][2:],
+                         [Str(u'eq.\u00a0'),
+                          {'t': 'Link',
+                           'c': [['', [], []], [Str('1')], ['#eq:a', '']]},
+                          Str('.')])
+
+    def test_state_file(self):
+        # Old documents are filtered in full, ignoring the state file
+        expected, _ = run_filter(broken_ref_doc(), 'html', '1.17')
+        meta = {'eqnos-state': MetaString(self.path('state'))}
+        for _ in range(2):
+            out, _ = run_filter(broken_ref_doc(meta), 'html', '1.17')
+            self.assertEqual(out[1], expected[1])
+
+
+# Server ---------------------------------------------------------------------
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs unix sockets')
+class TestServer(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.sockpath = self.path('eqnos.sock')
+        self.env = {'PANDOC_EQNOS_SOCKET': self.sockpath}
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.kill()
+            self.server.wait()
+            self.server.stderr.close()
+        TempDirTestCase.tearDown(self)
+
+    def start_server(self):
+        """Starts a server and waits until it is serving."""
+        # Run the server as the pandoc-eqnos script does
+        self.server = subprocess.Popen(
+            [sys.executable, '-c', 'import pandoc_eqnos; pandoc_eqnos.main()',
+             '--serve', self.sockpath],
+            cwd=os.path.dirname(os.path.abspath(pandoc_eqnos.__file__)),
+            stderr=subprocess.PIPE)
+        self.assertIn(b'Serving on', self.server.stderr.readline())
+
+    def test_requests(self):
+        self.start_server()
+        doc = duplicate_label_doc()
+        for fmt in ['html', 'latex']:
+            self.assertEqual(run_filter(doc, fmt, env=self.env),
+                             run_filter(doc, fmt))
+        doc = broken_ref_doc()
+        self.assertEqual(run_filter(doc, pandocversion='1.17', env=self.env),
+                         run_filter(doc, pandocversion='1.17'))
+        # Check that the server, and not the fallback, did the filtering
+        reply, data = pandoc_eqnos.request(
+            self.sockpath, json.dumps(duplicate_label_doc()).encode('utf-8'),
+            'html', PANDOC_VERSION)
+        self.assertEqual(reply['status'], 'ok')
+        self.assertEqual((json.loads(data.decode('utf-8')), reply['stderr']),
+                         run_filter(duplicate_label_doc()))
+
+    def test_error(self):
+        self.start_server()
+        reply, data = pandoc_eqnos.request(
+            self.sockpath, b'{"blocks": "eq:x"', 'html', PANDOC_VERSION)
+        self.assertEqual((reply['status'], data), ('error', b''))
+        self.assertIn('Traceback', reply['message'])
+
+    def test_sigterm(self):
+        self.start_server()
+        self.server.send_signal(signal.SIGTERM)
+        self.assertEqual(self.server.wait(), 0)
+        self.assertFalse(os.path.exists(self.sockpath))
+
+    def test_no_server(self):
+        doc = duplicate_label_doc()
+        self.assertEqual(run_filter(doc, env=self.env), run_filter(doc))
+
+    def test_empty_reply(self):
+        # A server that reads the request and hangs up without replying
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.sockpath)
+        sock.listen(1)
+        def hang_up():
+            conn, _ = sock.accept()
+            while conn.recv(1 << 16):
+                pass
+            conn.close()
+        thread = threading.Thread(target=hang_up)
+        thread.start()
+        try:
+            doc = duplicate_label_doc()
+            self.assertEqual(run_filter(doc, env=self.env), run_filter(doc))
+        finally:
+            thread.join()
+            sock.close()
+
+
+# Batch processing -----------------------------------------------------------
+
+def run_subcommand(name, argv, stdin=b''):
+    """Runs the subcommand `name` with the command-line arguments `argv`.
+    Returns its return value, stdout and stderr."""
+    stdout = io.BytesIO()
+    stderr = io.StringIO()
+    old = pandoc_eqnos._set_stderr(stderr)
+    try:
+        if name == 'batch':
+            ret = pandoc_eqnos.batch(argv, io.BytesIO(stdin), stdout)
+        else:
+            ret = pandoc_eqnos.SUBCOMMANDS[name](argv)
+    finally:
+        pandoc_eqnos._set_stderr(old)
+    return ret, stdout.getvalue(), stderr.getvalue()
+
+
+def write_json(path, doc):
+    """Writes `doc` to the json file at `path`."""
+    with open(path, 'w') as f:
+        json.dump(doc, f)
+
+
+class TestBatch(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        os.mkdir(self.path('in'))
+        os.mkdir(self.path('out'))
+
+    def test_files(self):
+        docs = [generate(10, 20, seed=n) for n in range(3)]
+        paths = [self.path('in/d%d.json' % n) for n in range(3)]
+        for path, doc in zip(paths, docs):
+            write_json(path, doc)
+        for jobs in ['1', '2']:
+            ret, _, _ = run_subcommand('batch', ['html', '-o',
+                                                 self.path('out'), '-j', jobs,
+                                                 '-q'] + paths)
+            self.assertEqual(ret, 0)
+            for n, doc in enumerate(docs):
+                with open(self.path('out/d%d.json' % n)) as f:
+                    self.assertEqual(json.load(f), run_filter(doc)[0])
+
+    def test_lines(self):
+        docs = [generate(10, 20, seed=n) for n in range(3)]
+        lines = b''.join(json.dumps(doc).encode('utf-8') + b'\n'
+                         for doc in docs)
+        ret, out, _ = run_subcommand('batch', ['html', '-j', '1', '-q'], lines)
+        self.assertEqual(ret, 0)
+        self.assertEqual([json.loads(line) for line in out.splitlines()],
+                         [run_filter(doc)[0] for doc in docs])
+
+    def test_invalid_json(self):
+        lines = b'{not json\n{bad\n' + json.dumps(generate(1, 1)).encode()
+        ret, out, err = run_subcommand('batch', ['html', '-j', '1'], lines)
+        self.assertEqual(ret, 2)
+        self.assertEqual(err.count(': failed'), 2)
+        out = [json.loads(line) for line in out.splitlines()]
+        self.assertIn('pandoc-eqnos-error', out[0])
+        self.assertIn('pandoc-eqnos-error', out[1])
+        self.assertNotIn('pandoc-eqnos-error', out[2])
+
+        with open(self.path('in/bad.json'), 'wb') as f:
+            f.write(b'{bad')
+        ret, _, _ = run_subcommand('batch', ['html', '-o', self.path('out'),
+                                             '-j', '1',
+                                             self.path('in/bad.json')])
+        self.assertEqual(ret, 1)
+        self.assertFalse(os.path.exists(self.path('out/bad.json')))
+
+    def test_duplicate_names(self):
+        os.mkdir(self.path('in/a'))
+        os.mkdir(self.path('in/b'))
+        for name in ['a', 'b']:
+            write_json(self.path('in/%s/doc.json' % name), generate(1, 1))
+        stderr = sys.stderr
+        sys.stderr = io.StringIO()
+        try:
+            with self.assertRaises(SystemExit):
+                run_subcommand('batch', ['html', '-o', self.path('out'),
+                                         self.path('in/a/doc.json'),
+                                         self.path('in/b/doc.json')])
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(os.listdir(self.path('out')), [])
+
+
+# Parallel processing --------------------------------------------------------
+
+def filter_bytes(doc, fmt='html', pandocversion=PANDOC_VERSION, env=None):
+    """Runs filter_bytes() on `doc` with the environment variables `env`
+    set.  Returns the output document and the warnings."""
+    stderr = io.StringIO()
+    old = pandoc_eqnos._set_stderr(stderr)
+    try:
+        with environment(env):
+            out = pandoc_eqnos.filter_bytes(
+                json.dumps(doc).encode('utf-8'), fmt, pandocversion)
+    finally:
+        pandoc_eqnos._set_stderr(old)
+    return json.loads(out.decode('utf-8')), stderr.getvalue()
+
+
+def parallel_env(jobs):
+    """Returns the environment for filtering with `jobs` workers."""
+    return {'PANDOC_EQNOS_JOBS': str(jobs),
+            'PANDOC_EQNOS_PARALLEL_SIZE': '1'}
+
+
+def duplicate_label_doc():
+    """Returns a document with a duplicated label, references to it at the
+    start and end, and a bad reference."""
+    doc = generate(30, 40, seed=3)
+    refs = Para([Cite('eq:dup'), SPACE, Cite('eq:missing')])
+    doc['blocks'][:0] = [refs, Para([Str('text')]), equation('eq:dup')]
+    doc['blocks'] += [equation('eq:dup'), refs]
+    doc['meta']['eqnos-unknown'] = MetaString('x')
+    return doc
+
+
+class TestParallel(unittest.TestCase):
+
+    def test_duplicate_label(self):
+        doc = duplicate_label_doc()
+        expected = run_filter(doc)
+        self.assertEqual(expected[1].count('duplicate'), 2)
+        for jobs in [2, 3, 5]:
+            self.assertEqual(filter_bytes(doc, env=parallel_env(jobs)),
+                             expected)
+
+    def test_old_document(self):
+        doc = broken_ref_doc({'eqnos-unknown': MetaString('x')})
+        expected = run_filter(doc, 'html', '1.17')
+        out = filter_bytes(doc, 'html', '1.17', parallel_env(3))
+        self.assertEqual(out, expected)
+        self.assertEqual(out[1].count('eqnos-unknown'), 1)
+
+
+# Label manifest -------------------------------------------------------------
+
+class TestManifest(TempDirTestCase):
+
+    def manifest_doc(self, blocks):
+        """Returns a document with `blocks` that writes a manifest and a
+        depfile."""
+        return {'pandoc-api-version': [1, 22], 'blocks': blocks,
+                'meta': {'eqnos-manifest': MetaString(self.path('m.json')),
+                         'eqnos-depfile': MetaString(self.path('doc.html.d'))}}
+
+    def read_manifest(self):
+        """Returns the manifest."""
+        with open(self.path('m.json')) as f:
+            return json.load(f)
+
+    def test_manifest(self):
+        run_filter(self.manifest_doc(
+            [equation('eq:a'), equation('eq:b'),
+             Para([Cite('eq:b'), SPACE, Cite('eq:c')])]))
+        manifest = self.read_manifest()
+        self.assertEqual(manifest['defines'], {'eq:a': [1, 0],
+                                               'eq:b': [2, 0]})
+        self.assertEqual(manifest['references'], {'eq:b': [2, 0],
+                                                  'eq:c': None})
+        self.assertEqual(manifest['unresolved'], ['eq:c'])
+        with open(self.path('doc.html.d')) as f:
+            self.assertEqual(f.read(), self.path('doc.html') + ':\n')
+
+    def test_no_equations(self):
+        # A document without equations isn't passed through; its manifest
+        # must still be written, and replace any earlier one
+        run_filter(self.manifest_doc([equation('eq:x')]))
+        self.assertEqual(list(self.read_manifest()['defines']), ['eq:x'])
+        run_filter(self.manifest_doc([Para([Str('text')])]))
+        self.assertEqual(self.read_manifest()['defines'], {})
+        self.assertTrue(os.path.exists(self.path('doc.html.d')))
+
+
+# Result cache ---------------------------------------------------------------
+
+class TestCache(TempDirTestCase):
+
+    def test_cache(self):
+        doc = duplicate_label_doc()
+        expected = run_filter(doc)
+        env = {'PANDOC_EQNOS_CACHE': self.tmpdir}
+        self.assertEqual(filter_bytes(doc, env=env), expected)
+        self.assertTrue(os.listdir(self.tmpdir))
+        # The second result comes from the cache, with its warnings
+        self.assertEqual(filter_bytes(doc, env=env), expected)
+        self.assertNotEqual(filter_bytes(doc, 'latex', env=env), expected)
+
+
+# Label index ----------------------------------------------------------------
+
+def split_chapters(doc):
+    """Splits `doc` into three chapter documents at its level-1 headers;
+    the second chapter starts partway through a section."""
+    blocks = doc['blocks']
+    starts = [n for n, block in enumerate(blocks)
+              if block['t'] == 'Header' and block['c'][0] == 1]
+    cuts = [0, starts[1] + 3, starts[3], len(blocks)]
+    return [dict(doc, meta=copy.deepcopy(doc['meta']),
+                 blocks=blocks[cuts[n]:cuts[n+1]]) for n in range(3)]
+
+
+class TestIndex(TempDirTestCase):
+
+    def check_book(self, meta, fmt):
+        """Checks that the chapters of a book filtered with a label index
+        give the same blocks as the whole book."""
+        doc = generate(27, 40, sections=5, tagged=0.2, meta=meta, seed=7)
+        expected = run_filter(doc, fmt)[0]['blocks']
+        paths = []
+        for n, chapter in enumerate(split_chapters(doc)):
+            paths.append(self.path('ch%d.json' % n))
+            write_json(paths[-1], chapter)
+        ret, _, _ = run_subcommand('index', [fmt] + paths + [
+            '-o', self.path('book.idx'), '--pandocversion', PANDOC_VERSION])
+        self.assertEqual(ret, 0)
+        blocks = []
+        for n, path in enumerate(paths):
+            with open(path) as f:
+                chapter = json.load(f)
+            chapter['meta']['eqnos-index'] = MetaString(self.path('book.idx'))
+            chapter['meta']['eqnos-index-chapter'] = MetaString('ch%d' % n)
+            blocks += run_filter(chapter, fmt)[0]['blocks']
+        self.assertEqual(blocks, expected)
+
+    def test_index(self):
+        for fmt in ['html', 'latex']:
+            self.check_book({}, fmt)
+
+    def test_index_by_section(self):
+        for fmt in ['html', 'latex']:
+            self.check_book({'eqnos-number-by-section': MetaBool(True)}, fmt)
+
+
+# Incremental filtering ------------------------------------------------------
+
+class TestIncremental(TempDirTestCase):
+
+    def test_edits(self):
+        doc = generate(30, 60, sections=5, tagged=0.2, seed=2)
+        edits = [lambda blocks: None,  # Unchanged
+                 lambda blocks: blocks.insert(5, equation('eq:new')),
+                 lambda blocks: blocks.append(Para([Cite('eq:new')])),
+                 lambda blocks: blocks.__delitem__(5),
+                 lambda blocks: blocks.insert(0, Para([Str('text')]))]
+        for n, edit in enumerate(edits):
+            edit(doc['blocks'])
+            doc['meta'] = {'eqnos-state': MetaString(self.path('state'))}
+            out = run_filter(doc)
+            self.assertTrue(os.path.exists(self.path('state')))
+            # A fresh state file gives the full result
+            fresh = dict(doc, meta={'eqnos-state':
+                                    MetaString(self.path('fresh%d' % n))})
+            expected = run_filter(fresh)
+            expected[0]['meta'] = out[0]['meta']
+            self.assertEqual(out, expected)
+
+
+# Streaming ------------------------------------------------------------------
+
+class TestStream(TempDirTestCase):
+
+    def test_stream(self):
+        for meta in [{}, {'eqnos-number-by-section': MetaBool(True)}]:
+            doc = duplicate_label_doc()
+            doc['meta'].update(meta)
+            write_json(self.path('doc.json'), doc)
+            for fmt in ['html', 'latex']:
+                ret, _, _ = run_subcommand('stream', [
+                    fmt, self.path('doc.json'), '-o', self.path('out.json'),
+                    '--pandocversion', PANDOC_VERSION])
+                self.assertEqual(ret, 0)
+                with open(self.path('out.json')) as f:
+                    self.assertEqual(json.load(f), run_filter(doc, fmt)[0])
+
+
+# Multiple formats -----------------------------------------------------------
+
+FORMATS = ['latex', 'html', 'html4', 'epub', 'docx', 'plain']
+
+class TestMulti(TempDirTestCase):
+
+    def test_multi(self):
+        for meta in [{}, {'eqnos-number-by-section': MetaBool(True)}]:
+            doc = duplicate_label_doc()
+            doc['meta'].update(meta)
+            write_json(self.path('doc.json'), doc)
+            args = [self.path('doc.json'), '-o', self.path('out'),
+                    '--pandocversion', PANDOC_VERSION]
+            for fmt in FORMATS:
+                args += ['-t', fmt]
+            ret, _, _ = run_subcommand('multi', args)
+            self.assertEqual(ret, 0)
+            for fmt in FORMATS:
+                with open(self.path('out/doc.%s.json' % fmt)) as f:
+                    self.assertEqual(json.load(f), run_filter(doc, fmt)[0])
+
+    def test_warnings(self):
+        doc = duplicate_label_doc()
+        data = json.dumps(doc).encode('utf-8')
+        for fmt, (out, error, stderr) in zip(
+                FORMATS, pandoc_eqnos.filter_formats(data, FORMATS,
+                                                     PANDOC_VERSION)):
+            self.assertIsNone(error)
+            self.assertEqual((json.loads(out.decode('utf-8')), stderr),
+                             run_filter(doc, fmt))
+
+
+# Build driver ---------------------------------------------------------------
+
+# A stand-in for pandoc.  Its sources are json documents, which it copies to
+# stdout when asked to read them; when writing, it copies stdin to the -o
+# path.  Sources and outputs with 'fail' in their names fail.
+STANDIN_PANDOC = """#! %s
+import sys
+args = sys.argv[1:]
+if args == ['--version']:
+    sys.stdout.write('pandoc 2.11.4\\n')
+elif '-o' in args:
+    path = args[args.index('-o')+1]
+    if 'fail' in path:
+        sys.stderr.write('cannot write ' + path)
+        sys.exit(1)
+    with open(path, 'wb') as f:
+        f.write(sys.stdin.buffer.read())
+elif 'fail' in args[0]:
+    sys.stderr.write('cannot read ' + args[0])
+    sys.exit(1)
+else:
+    with open(args[0], 'rb') as f:
+        sys.stdout.buffer.write(f.read())
+"""
+
+class TestBuild(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.pandoc = self.path('pandoc')
+        with open(self.pandoc, 'w') as f:
+            f.write(STANDIN_PANDOC % sys.executable)
+        os.chmod(self.pandoc, 0o755)
+
+    def build(self, args):
+        """Runs the build subcommand with `args`.  Returns its return
+        value."""
+        return run_subcommand('build', args + ['-o', self.path('out'),
+                                               '--pandoc', self.pandoc])[0]
+
+    def test_build(self):
+        docs = [duplicate_label_doc(), generate(10, 10, seed=1)]
+        paths = [self.path('d%d.json' % n) for n in range(2)]
+        for path, doc in zip(paths, docs):
+            write_json(path, doc)
+        self.assertEqual(self.build(paths + ['-t', 'html', '-t', 'latex',
+                                             '-j', '2']), 0)
+        for n, doc in enumerate(docs):
+            for fmt, ext in [('html', 'html'), ('latex', 'tex')]:
+                with open(self.path('out/d%d.%s' % (n, ext))) as f:
+                    self.assertEqual(json.load(f), run_filter(doc, fmt)[0])
+
+    def test_failures(self):
+        paths = [self.path('ok.json'), self.path('fail.json')]
+        write_json(paths[0], generate(5, 5))
+        self.assertEqual(self.build(paths + ['-t', 'html', '-t', 'latex']), 2)
+        self.assertEqual(sorted(os.listdir(self.path('out'))),
+                         ['ok.html', 'ok.tex'])
+
+
+# Chaining -------------------------------------------------------------------
+
+class OtherFilter(object):
+    """A chained filter that numbers nothing and owns the fig: labels.  It
+    counts the headers and references it is shown."""
+
+    def __init__(self):
+        self.headers = 0
+        self.refs = 0
+
+    def start(self, doc):
+        return (doc['meta'], doc['blocks']) if isinstance(doc, dict) else \
+          (doc[0]['unMeta'], doc[1:])
+
+    def first_pass_actions(self):
+        def count_headers(key, value, fmt, meta):
+            if key == 'Header':
+                self.headers += 1
+        return [count_headers], []
+
+    def second_pass_actions(self):
+        def count_refs(key, value, fmt, meta):
+            if key == 'Cite' and len(value) == 3:
+                self.refs += 1
+        return [count_refs], []
+
+    def add_headers(self, meta):
+        pass
+
+    @staticmethod
+    def owns_label(label):
+        return label.startswith('fig:')
+
+
+class TestChain(unittest.TestCase):
+
+    def run_chain(self, doc, fmt='html', pandocversion=PANDOC_VERSION):
+        """Runs the chain of eqnos and another filter on `doc`.  Returns the
+        output document and the other filter."""
+        other = OtherFilter()
+        stderr = io.StringIO()
+        old = pandoc_eqnos._set_stderr(stderr)
+        try:
+            out = pandoc_eqnos.run_chain(
+                copy.deepcopy(doc),
+                [pandoc_eqnos.EqnosFilter(fmt, pandocversion), other], fmt)
+        finally:
+            pandoc_eqnos._set_stderr(old)
+        return json.loads(json.dumps(out)), other
+
+    def test_chain(self):
+        doc = generate(20, 40, sections=4)
+        for fmt in ['html', 'latex']:
+            out, other = self.run_chain(doc, fmt)
+            self.assertEqual(out, run_filter(doc, fmt)[0])
+            self.assertEqual(other.headers, 0)
+            self.assertEqual(other.refs, 0)
+
+    def test_old_document(self):
+        out, _ = self.run_chain(broken_ref_doc(), 'html', '1.17')
+        self.assertEqual(out, run_filter(broken_ref_doc(), 'html', '1.17')[0])
+
+
+if __name__ == '__main__':
+    unittest.main()